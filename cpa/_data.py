@@ -1,10 +1,48 @@
 from typing import Optional
 
+import numpy as np
+import torch.distributed as dist
 from scvi import settings
 from scvi.data import AnnDataManager
 from scvi.dataloaders import DataSplitter, AnnDataLoader
 from scvi.model._utils import parse_use_gpu_arg
 
+from ._utils import CPA_REGISTRY_KEYS
+
+
+def get_data_and_attributes(adata_manager: AnnDataManager):
+    """Returns the dtype of each registered field, loading categorical fields directly as int64 indices"""
+    categorical_keys = set(CPA_REGISTRY_KEYS.CAT_COV_KEYS) | {CPA_REGISTRY_KEYS.PERTURBATION_KEY,
+                                                              CPA_REGISTRY_KEYS.PERTURBATIONS,
+                                                              CPA_REGISTRY_KEYS.CATEGORY_KEY}
+    return {
+        key: np.int64 if key in categorical_keys else np.float32
+        for key in adata_manager.data_registry.keys()
+    }
+
+
+def get_worker_kwargs(num_workers: int = 0):
+    """Returns the DataLoader worker arguments, keeping workers alive and prefetching if `num_workers > 0`"""
+    if num_workers > 0:
+        return dict(num_workers=num_workers, persistent_workers=True, prefetch_factor=4)
+
+    return dict()
+
+
+def use_pinned_memory(pin_memory: Optional[bool], use_gpu) -> bool:
+    """Returns whether batches are pinned: when training on GPU unless `pin_memory` is `False`"""
+    accelerator, _, _ = parse_use_gpu_arg(use_gpu, return_device=True)
+    return pin_memory is not False and accelerator == "gpu"
+
+
+def shard_indices(indices, rank: int, world_size: int, seed: int = 0, epoch: int = 0):
+    """Returns the share of `indices` for process `rank`, truncated so that every process gets the same number of cells.
+    Like `DistributedSampler.set_epoch`, `indices` are shuffled with `seed + epoch` before being dealt to processes.
+    """
+    indices = np.random.RandomState(seed + epoch).permutation(np.asarray(indices))
+    n_per_rank = len(indices) // world_size
+    return indices[rank::world_size][:n_per_rank]
+
 
 class AnnDataSplitter(DataSplitter):
     def __init__(
@@ -14,11 +52,15 @@ class AnnDataSplitter(DataSplitter):
             valid_indices,
             test_indices,
             use_gpu: bool = False,
+            distributed: bool = False,
+            pin_memory: Optional[bool] = None,
             **kwargs,
     ):
         super().__init__(adata_manager)
         self.data_loader_kwargs = kwargs
         self.use_gpu = use_gpu
+        self.distributed = distributed
+        self.pin_memory_gpu = pin_memory
         self.train_idx = train_indices
         self.val_idx = valid_indices
         self.test_idx = test_indices
@@ -27,17 +69,21 @@ class AnnDataSplitter(DataSplitter):
         accelerator, _, self.device = parse_use_gpu_arg(
             self.use_gpu, return_device=True
         )
-        self.pin_memory = (
-            True
-            if (settings.dl_pin_memory_gpu_training and accelerator == "gpu")
-            else False
-        )
+        # pinned batches are copied to the GPU asynchronously by Lightning
+        self.pin_memory = use_pinned_memory(self.pin_memory_gpu, self.use_gpu)
 
     def train_dataloader(self):
         if len(self.train_idx) > 0:
+            train_idx = self.train_idx
+            if self.distributed and dist.is_available() and dist.is_initialized():
+                # AnnDataLoader builds its own BatchSampler, so each process is given its share of cells directly.
+                # The loader is rebuilt every epoch, which deals the cells to processes anew
+                epoch = self.trainer.current_epoch if self.trainer is not None else 0
+                train_idx = shard_indices(train_idx, dist.get_rank(), dist.get_world_size(),
+                                          seed=settings.seed or 0, epoch=epoch)
             return AnnDataLoader(
                 self.adata_manager,
-                indices=self.train_idx,
+                indices=train_idx,
                 shuffle=True,
                 pin_memory=self.pin_memory,
                 **self.data_loader_kwargs,
@@ -73,3 +119,15 @@ class AnnDataSplitter(DataSplitter):
             )
         else:
             pass
+
+
+class RandomDataSplitter(DataSplitter):
+    """`DataSplitter` that pins host memory when training on GPU, like `AnnDataSplitter`"""
+
+    def __init__(self, adata_manager: AnnDataManager, pin_memory: Optional[bool] = None, **kwargs):
+        super().__init__(adata_manager, **kwargs)
+        self.pin_memory_gpu = pin_memory
+
+    def setup(self, stage: Optional[str] = None):
+        super().setup(stage)
+        self.pin_memory = use_pinned_memory(self.pin_memory_gpu, self.use_gpu)
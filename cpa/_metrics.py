@@ -1,4 +1,5 @@
 import numpy as np
+import torch
 from scipy.stats import entropy
 from sklearn.neighbors import NearestNeighbors
 from sklearn.preprocessing import LabelEncoder
@@ -19,10 +20,19 @@ def knn_purity(data, labels: np.ndarray, n_neighbors=30):
         score: float
             KNN purity score. A float between 0 and 1.
     """
-    labels = LabelEncoder().fit_transform(labels.ravel())
+    return neighbors_purity(knn_indices(data, n_neighbors=n_neighbors), labels)
+
 
+def knn_indices(data, n_neighbors=30):
+    """Returns the indices of the ``n_neighbors`` nearest neighbors of each row of ``data``, excluding itself"""
     nbrs = NearestNeighbors(n_neighbors=n_neighbors + 1).fit(data)
-    indices = nbrs.kneighbors(data, return_distance=False)[:, 1:]
+    return nbrs.kneighbors(data, return_distance=False)[:, 1:]
+
+
+def neighbors_purity(indices: np.ndarray, labels: np.ndarray):
+    """Computes KNN Purity from the neighbor ``indices`` of `knn_indices` given the labels"""
+    labels = LabelEncoder().fit_transform(labels.ravel())
+
     neighbors_labels = np.vectorize(lambda i: labels[i])(indices)
 
     # pre cell purity scores
@@ -34,6 +44,70 @@ def knn_purity(data, labels: np.ndarray, n_neighbors=30):
     return np.mean(res)
 
 
+def knn_purity_gpu(data: torch.Tensor, labels: torch.Tensor, n_neighbors=30, chunk_size=4096):
+    """Computes KNN Purity for ``data`` given the labels, without leaving ``data``'s device.
+        Parameters
+        ----------
+        data: torch.Tensor
+            Tensor of data with shape (n_obs, n_features)
+        labels: torch.Tensor
+            Tensor of labels with shape (n_obs,)
+        n_neighbors: int
+            Number of nearest neighbors.
+        chunk_size: int
+            Number of rows of the pairwise distance matrix computed at once.
+        Returns
+        -------
+        score: torch.Tensor
+            KNN purity score. A 0-d tensor between 0 and 1.
+    """
+    return neighbors_purity_gpu(knn_indices_gpu(data, n_neighbors=n_neighbors, chunk_size=chunk_size), labels)
+
+
+def knn_indices_gpu(data: torch.Tensor, n_neighbors=30, chunk_size=4096):
+    """Returns the indices of the ``n_neighbors`` nearest neighbors of each row of ``data``, excluding itself.
+    The pairwise distances are computed ``chunk_size`` rows at a time on ``data``'s device.
+    """
+    return torch.cat([
+        torch.cdist(chunk, data).topk(n_neighbors + 1, dim=1, largest=False).indices[:, 1:]
+        for chunk in data.split(chunk_size)
+    ])
+
+
+def neighbors_purity_gpu(indices: torch.Tensor, labels: torch.Tensor):
+    """Computes KNN Purity from the neighbor ``indices`` of `knn_indices_gpu` given the labels"""
+    _, labels = torch.unique(labels.view(-1), return_inverse=True)
+
+    # pre cell purity scores
+    scores = (labels[indices] == labels.view(-1, 1)).float().mean(dim=1)
+    counts = torch.bincount(labels)
+    res = torch.zeros(counts.shape[0], device=indices.device).index_add_(0, labels, scores) / counts  # per cell-type purity
+
+    return res.mean()
+
+
+def r2_score(pred: torch.Tensor, target: torch.Tensor, eps: float = 1e-8):
+    """Computes the R2 score of ``pred`` given ``target``.
+        The total sum of squares is clamped to ``eps``, so a constant ``target`` does not produce NaNs.
+        Parameters
+        ----------
+        pred: torch.Tensor
+            Tensor of predictions
+        target: torch.Tensor
+            Tensor of targets, with the same shape as ``pred``
+        eps: float
+            Lower bound of the total sum of squares.
+        Returns
+        -------
+        score: torch.Tensor
+            R2 score. A 0-d tensor.
+    """
+    ss_res = (target - pred).pow(2).sum()
+    ss_tot = (target - target.mean()).pow(2).sum().clamp_min(eps)
+
+    return 1 - ss_res / ss_tot
+
+
 def entropy_batch_mixing(data, labels,
                          n_neighbors=50, n_pools=50, n_samples_per_pool=100):
     """Computes Entory of Batch mixing metric for ``adata`` given the batch column name.
@@ -7,8 +7,8 @@ import numpy as np
 import pandas as pd
 import torch
 from pytorch_lightning.callbacks import EarlyStopping
+from pytorch_lightning.strategies import DDPStrategy
 from scvi.data import AnnDataManager
-from scvi.dataloaders import DataSplitter
 from torch.nn import functional as F
 from scvi.data.fields import (
     LayerField,
@@ -19,7 +19,7 @@ from scvi.data.fields import (
 
 from anndata import AnnData
 from scvi.model.base import BaseModelClass
-from scvi.train import TrainRunner
+from scvi.train import TrainRunner, Trainer
 from scvi.train._callbacks import SaveBestState
 from scvi.utils import setup_anndata_dsp
 from tqdm import tqdm
@@ -27,12 +27,25 @@ from tqdm import tqdm
 from ._module import CPAModule
 from ._utils import CPA_REGISTRY_KEYS
 from ._task import CPATrainingPlan
-from ._data import AnnDataSplitter
+from ._data import AnnDataSplitter, RandomDataSplitter, get_data_and_attributes, get_worker_kwargs
 
 logger = logging.getLogger(__name__)
 logger.propagate = False
 
 
+class _TrainRunner(TrainRunner):
+    """`TrainRunner` passing `devices` to the Trainer instead of the single device parsed from `use_gpu`"""
+
+    def __init__(self, *args, devices=None, **kwargs):
+        self._devices = devices
+        super().__init__(*args, **kwargs)
+
+    def _trainer_cls(self, **trainer_kwargs):
+        if self._devices is not None:
+            trainer_kwargs['devices'] = self._devices
+        return Trainer(**trainer_kwargs)
+
+
 class CPA(BaseModelClass):
     """CPA model
 
@@ -284,6 +297,8 @@ class CPA(BaseModelClass):
             early_stopping: bool = False,
             plan_kwargs: Optional[dict] = None,
             save_path: Optional[str] = None,
+            num_workers: int = 0,
+            pin_memory: Optional[bool] = None,
             **trainer_kwargs,
     ):
         """
@@ -306,20 +321,43 @@ class CPA(BaseModelClass):
         early_stopping: bool
             If `True`, EarlyStopping will be used during training on validation dataset
         plan_kwargs: dict
-            `CPATrainingPlan` parameters
+            `CPATrainingPlan` parameters. Step-based schedules (`n_steps_pretrain_ae`, `n_steps_adv_warmup`,
+            `n_steps_kl_warmup`) count training batches
         save_path: str
             Path to save the model after the end of training
+        num_workers: int
+            Number of DataLoader worker processes. Workers are persistent and prefetch batches if `num_workers > 0`
+        pin_memory: bool
+            Whether batches are loaded into pinned host memory when training on GPU. Defaults to `True`, set to
+            `False` to opt out. `scvi.settings.dl_pin_memory_gpu_training` is not used
+        **trainer_kwargs:
+            Other keyword arguments for `scvi.train.Trainer`. `devices` and `num_nodes` are passed to the
+            Trainer, `devices` replacing the single device selected by `use_gpu`. Passing `strategy='ddp'` uses
+            `DistributedDataParallel` with unused parameters detection enabled; a `DDPStrategy` instance is used
+            as is and should set `find_unused_parameters=True`. DDP requires `split_key`: every epoch, each
+            process trains on an equal, reshuffled share of the training cells, while validation runs on all
+            validation cells in every process so that `cpa_metric` agrees across processes. The model is saved
+            by the first process only. Note that `max_steps` counts optimizer steps: one per batch, or two if
+            `adv_steps=None` once adversarial training has started
         """
         if max_epochs is None:
             n_cells = self.adata.n_obs
             max_epochs = np.min([round((20000 / n_cells) * 400), 400])
         plan_kwargs = plan_kwargs if isinstance(plan_kwargs, dict) else dict()
 
+        data_and_attributes = get_data_and_attributes(self.adata_manager)
+        worker_kwargs = get_worker_kwargs(num_workers)
+
         manual_splitting = (
                 (self.valid_indices is not None)
                 and (self.train_indices is not None)
                 and (self.test_indices is not None)
         )
+        strategy = trainer_kwargs.get('strategy')
+        distributed = isinstance(strategy, DDPStrategy) or strategy == 'ddp'
+        if distributed and not manual_splitting:
+            raise ValueError("DDP training requires a `split_key` to be set in the model's constructor")
+
         if manual_splitting:
             data_splitter = AnnDataSplitter(
                 self.adata_manager,
@@ -328,14 +366,21 @@ class CPA(BaseModelClass):
                 test_indices=self.test_indices,
                 batch_size=batch_size,
                 use_gpu=use_gpu,
+                distributed=distributed,
+                pin_memory=pin_memory,
+                data_and_attributes=data_and_attributes,
+                **worker_kwargs,
             )
         else:
-            data_splitter = DataSplitter(
+            data_splitter = RandomDataSplitter(
                 self.adata_manager,
                 train_size=train_size,
                 validation_size=validation_size,
                 batch_size=batch_size,
                 use_gpu=use_gpu,
+                pin_memory=pin_memory,
+                data_and_attributes=data_and_attributes,
+                **worker_kwargs,
             )
 
         perturbation_key = CPA_REGISTRY_KEYS.PERTURBATION_KEY
@@ -367,13 +412,22 @@ class CPA(BaseModelClass):
         else:
             trainer_kwargs['callbacks'] = [es_callback]
 
+        if distributed:
+            if not isinstance(strategy, DDPStrategy):
+                # adversaries, the library encoder and the mixup branches do not receive gradients on every step
+                trainer_kwargs['strategy'] = DDPStrategy(find_unused_parameters=True)
+            # training cells are already sharded by `AnnDataSplitter`, Lightning cannot swap its batch sampler
+            trainer_kwargs['replace_sampler_ddp'] = False
+            # the shards are dealt anew every epoch
+            trainer_kwargs['reload_dataloaders_every_n_epochs'] = 1
+
         if save_path is None:
             save_path = './'
 
         checkpoint = SaveBestState(monitor='cpa_metric', mode='max', period=1, verbose=False)
         trainer_kwargs['callbacks'].append(checkpoint)
 
-        self.runner = TrainRunner(
+        self.runner = _TrainRunner(
             self,
             training_plan=self.training_plan,
             data_splitter=data_splitter,
@@ -385,8 +439,8 @@ class CPA(BaseModelClass):
         )
         self.runner()
 
-        self.epoch_history = pd.DataFrame().from_dict(self.training_plan.epoch_history)
-        if save_path is not False:
+        self.epoch_history = pd.DataFrame().from_dict(self.training_plan.epoch_history.to_dict())
+        if save_path is not False and self.runner.trainer.is_global_zero:
             self.save(save_path, overwrite=True)
 
     @torch.no_grad()
@@ -523,7 +577,7 @@ class CPA(BaseModelClass):
             covar_ids = torch.arange(len(self.covars_encoder[covariate]), device=self.device)
         else:
             covar_ids = torch.LongTensor([self.covars_encoder[covariate][covariate_value]]).to(self.device)
-        embeddings = self.module.covars_embeddings[covariate](covar_ids).detach().cpu().numpy()
+        embeddings = self.module.covar_embeddings(covariate, covar_ids).detach().cpu().numpy()
 
         return embeddings
 
@@ -542,7 +596,7 @@ class CPA(BaseModelClass):
             f.write(json_dict)
 
         if isinstance(self.epoch_history, dict):
-            self.epoch_history = pd.DataFrame().from_dict(self.training_plan.epoch_history)
+            self.epoch_history = pd.DataFrame().from_dict(self.training_plan.epoch_history.to_dict())
             self.epoch_history.to_csv(os.path.join(dir_path, 'history.csv'), index=False)
         elif isinstance(self.epoch_history, pd.DataFrame):
             self.epoch_history.to_csv(os.path.join(dir_path, 'history.csv'), index=False)
@@ -1,21 +1,38 @@
+from contextlib import contextmanager
+from types import MethodType
+
 import numpy as np
 import torch
 import torch.nn as nn
-from scvi import settings
-from scvi.distributions import NegativeBinomial, ZeroInflatedNegativeBinomial
 from scvi.module import Classifier
 from scvi.module.base import BaseModuleClass, auto_move_data
 from scvi.nn import Encoder, DecoderSCVI
 from torch.distributions import Normal
+from torch.utils.checkpoint import checkpoint
 from torch.distributions.kl import kl_divergence as kl
-from torchmetrics.functional import accuracy, pearson_corrcoef, r2_score
+from torchmetrics.functional import accuracy
 
-from ._metrics import knn_purity
-from ._utils import PerturbationNetwork, VanillaEncoder, CPA_REGISTRY_KEYS
+from ._metrics import knn_indices, knn_indices_gpu, neighbors_purity, neighbors_purity_gpu, r2_score
+from ._utils import PerturbationNetwork, VanillaEncoder, CPA_REGISTRY_KEYS, nb_log_prob, zinb_log_prob
 
 from typing import Optional
 
 
+@contextmanager
+def _preserve_batch_norm_stats(module: nn.Module):
+    """Restores the running statistics of every BatchNorm layer in `module` on exit"""
+    layers = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+    stats = [(m.running_mean.clone(), m.running_var.clone(), m.num_batches_tracked.clone()) for m in layers]
+    try:
+        yield
+    finally:
+        with torch.no_grad():
+            for m, (mean, var, n_batches) in zip(layers, stats):
+                m.running_mean.copy_(mean)
+                m.running_var.copy_(var)
+                m.num_batches_tracked.copy_(n_batches)
+
+
 class CPAModule(BaseModuleClass):
     """
     CPA module using Gaussian/NegativeBinomial Likelihood
@@ -44,6 +61,19 @@ class CPAModule(BaseModuleClass):
         use_layer_norm_encoder: bool
 
         variational: bool
+
+        seed: int
+            Seed of the local generator used to initialize `px_r`. The global random state is not modified
+
+        compile_graph: bool
+            If `True`, `inference` and `generative` are compiled with `torch.compile`
+
+        use_amp: bool
+            If `True`, the encoders and the decoder run under bfloat16 autocast
+
+        gradient_checkpointing: bool
+            If `True`, the encoder and decoder activations are recomputed during backward to save memory.
+            The recompute runs in train mode, so BatchNorm running statistics are restored around it
     """
 
     def __init__(self,
@@ -67,15 +97,17 @@ class CPAModule(BaseModuleClass):
                  dropout_rate_decoder: float = 0.0,
                  variational: bool = False,
                  seed: int = 0,
+                 compile_graph: bool = False,
+                 use_amp: bool = False,
+                 gradient_checkpointing: bool = False,
                  ):
         super().__init__()
 
         recon_loss = recon_loss.lower()
         assert recon_loss in ['gauss', 'zinb', 'nb']
 
-        torch.manual_seed(seed)
-        np.random.seed(seed)
-        settings.seed = seed
+        # global RNG state is left to the caller (e.g. `scvi.settings.seed`), only local draws use `seed`
+        generator = torch.Generator().manual_seed(seed)
 
         self.n_genes = n_genes
         self.n_perts = n_perts
@@ -83,6 +115,8 @@ class CPAModule(BaseModuleClass):
         self.recon_loss = recon_loss
         self.doser_type = doser_type
         self.variational = variational
+        self.use_amp = use_amp
+        self.gradient_checkpointing = gradient_checkpointing
 
         self.covars_encoder = covars_encoder
 
@@ -116,7 +150,8 @@ class CPAModule(BaseModuleClass):
         # Decoder components
         if self.recon_loss in ['zinb', 'nb']:
             # setup the parameters of your generative model, as well as your inference model
-            self.px_r = torch.nn.Parameter(torch.randn(self.n_genes))
+            self.px_r = torch.nn.Parameter(torch.randn(self.n_genes, generator=generator))
+            self._px_r_cache = None
 
             # l encoder goes from n_input-dimensional data to 1-d library size
             self.library_encoder = Encoder(
@@ -153,26 +188,59 @@ class CPAModule(BaseModuleClass):
             raise Exception('Invalid Loss function for Autoencoder')
 
         # Embeddings
-        # 1. Drug Network
+        # Drug Network, whose embedding table also holds the covariates (indexed with per-covariate offsets)
         self.pert_network = PerturbationNetwork(n_perts=n_perts,
                                                 n_latent=n_latent,
                                                 doser_type=doser_type,
                                                 n_hidden=n_hidden_doser,
                                                 n_layers=n_layers_doser,
+                                                n_covars=[len(unique_covars)
+                                                          for unique_covars in self.covars_encoder.values()],
                                                 )
-
-        # 2. Covariates Embedding
-        self.covars_embeddings = nn.ModuleDict(
-            {
-                key: torch.nn.Embedding(len(unique_covars), n_latent)
-                for key, unique_covars in self.covars_encoder.items()
-            }
-        )
-
-        self.metrics = {
-            'pearson_r': pearson_corrcoef,
-            'r2_score': r2_score
-        }
+        self._register_load_state_dict_pre_hook(self._load_embeddings)
+
+        self.register_buffer('_zero', torch.zeros(()), persistent=False)
+        self.register_buffer('_one', torch.ones(()), persistent=False)
+
+        self.compile_graph = compile_graph
+        if compile_graph:
+            # compile the undecorated methods so that `auto_move_data` stays outside the graph
+            self.inference = MethodType(
+                auto_move_data(torch.compile(CPAModule.inference.__wrapped__, mode='default', dynamic=True)), self)
+            self.generative = MethodType(
+                auto_move_data(torch.compile(CPAModule.generative.__wrapped__, mode='default', dynamic=True)), self)
+
+    def _checkpoint(self, module, *inputs):
+        """Runs `module`, recomputing its activations in backward if gradient checkpointing is enabled"""
+        if self.gradient_checkpointing and self.training and torch.is_grad_enabled():
+            n_calls = [0]
+
+            def run(*args):
+                # the recompute in backward runs in train mode too, BatchNorm statistics are only updated once
+                n_calls[0] += 1
+                if n_calls[0] > 1:
+                    with _preserve_batch_norm_stats(module):
+                        return module(*args)
+                return module(*args)
+
+            return checkpoint(run, *inputs, use_reentrant=False)
+
+        return module(*inputs)
+
+    def _load_embeddings(self, state_dict, prefix, *args):
+        """Merges the perturbation and covariate embeddings of older checkpoints into `pert_network.embedding`"""
+        pert_key = f'{prefix}pert_network.pert_embedding.weight'
+        if pert_key not in state_dict:
+            return
+
+        covar_keys = [f'{prefix}covars_embeddings.{covar}.weight' for covar in self.covars_encoder.keys()]
+        weights = [state_dict.pop(pert_key)] + [state_dict.pop(key) for key in covar_keys if key in state_dict]
+        state_dict[f'{prefix}pert_network.embedding.weight'] = torch.cat(weights, dim=0)
+
+    def covar_embeddings(self, covar, covar_ids):
+        """Returns the embeddings of `covar_ids` for covariate `covar`"""
+        offset = self.pert_network.covars_offsets[list(self.covars_encoder.keys()).index(covar)]
+        return self.pert_network.embedding(covar_ids + offset)
 
     def mixup_data(self, tensors, alpha: float = 0.0, opt=False):
         """
@@ -180,50 +248,68 @@ class CPAModule(BaseModuleClass):
         """
         alpha = max(0.0, alpha)
 
-        if alpha == 0.0:
-            mixup_lambda = 1.0
-        else:
-            mixup_lambda = np.random.beta(alpha, alpha)
-
         x = tensors[CPA_REGISTRY_KEYS.X_KEY]
-        y_perturbations = tensors[CPA_REGISTRY_KEYS.PERTURBATION_KEY]
         perturbations = tensors[CPA_REGISTRY_KEYS.PERTURBATIONS]
         perturbations_dosages = tensors[CPA_REGISTRY_KEYS.PERTURBATIONS_DOSAGES]
+        labels_keys = [CPA_REGISTRY_KEYS.PERTURBATION_KEY] + list(self.covars_encoder.keys())
+
+        # categorical labels are used as flat int64 indices from here on (no-op if the loader already did it)
+        for key in labels_keys:
+            tensors[key] = tensors[key].view(-1, ).long()
+        y_perturbations = tensors[CPA_REGISTRY_KEYS.PERTURBATION_KEY]
+
+        tensors[CPA_REGISTRY_KEYS.X_KEY + '_true'] = x
+
+        if alpha == 0.0:
+            # nothing is mixed, the mixup targets are the original ones
+            tensors[CPA_REGISTRY_KEYS.X_KEY + '_mixup'] = x
+            tensors[CPA_REGISTRY_KEYS.PERTURBATIONS + '_mixup'] = perturbations
+            tensors[CPA_REGISTRY_KEYS.PERTURBATIONS_DOSAGES + '_mixup'] = perturbations_dosages
+            for key in labels_keys:
+                tensors[key + '_mixup'] = tensors[key]
+
+            return tensors, 1.0
+
+        mixup_lambda = np.random.beta(alpha, alpha)
 
         batch_size = x.size()[0]
-        index = torch.randperm(batch_size).to(x.device)
+        index = torch.randperm(batch_size, device=x.device)
 
-        mixed_x = mixup_lambda * x + (1. - mixup_lambda) * x[index, :]
+        x_mixup = x.index_select(0, index)
+        mixed_x = mixup_lambda * x + (1. - mixup_lambda) * x_mixup
 
         tensors[CPA_REGISTRY_KEYS.X_KEY] = mixed_x
-        tensors[CPA_REGISTRY_KEYS.X_KEY + '_true'] = x
-        tensors[CPA_REGISTRY_KEYS.X_KEY + '_mixup'] = x[index]
-        tensors[CPA_REGISTRY_KEYS.PERTURBATION_KEY + '_mixup'] = y_perturbations[index]
-        tensors[CPA_REGISTRY_KEYS.PERTURBATIONS + '_mixup'] = perturbations[index]
-        tensors[CPA_REGISTRY_KEYS.PERTURBATIONS_DOSAGES + '_mixup'] = perturbations_dosages[index]
+        tensors[CPA_REGISTRY_KEYS.X_KEY + '_mixup'] = x_mixup
+        tensors[CPA_REGISTRY_KEYS.PERTURBATIONS + '_mixup'] = perturbations.index_select(0, index)
+        tensors[CPA_REGISTRY_KEYS.PERTURBATIONS_DOSAGES + '_mixup'] = perturbations_dosages.index_select(0, index)
 
-        for covar, encoder in self.covars_encoder.items():
-            tensors[covar + '_mixup'] = tensors[covar][index]
+        # perturbation labels and covariates are gathered at once
+        labels = torch.stack([y_perturbations] + [tensors[covar] for covar in self.covars_encoder.keys()], dim=1)
+        labels_mixup = labels.index_select(0, index).unbind(dim=1)
+        for key, label_mixup in zip(labels_keys, labels_mixup):
+            tensors[key + '_mixup'] = label_mixup
 
         return tensors, mixup_lambda
 
-    def _get_inference_input(self, tensors):
+    def _get_inference_input(self, tensors, mixup_lambda: float = 1.0):
         x = tensors[CPA_REGISTRY_KEYS.X_KEY]  # batch_size, n_genes
         perts = {
             'true': tensors[CPA_REGISTRY_KEYS.PERTURBATIONS],
-            'mixup': tensors[CPA_REGISTRY_KEYS.PERTURBATIONS + '_mixup']
         }
         perts_doses = {
             'true': tensors[CPA_REGISTRY_KEYS.PERTURBATIONS_DOSAGES],
-            'mixup': tensors[CPA_REGISTRY_KEYS.PERTURBATIONS_DOSAGES + '_mixup'],
         }
 
         covars_dict = dict()
         for covar, unique_covars in self.covars_encoder.items():
-            encoded_covars = tensors[covar].view(-1, )  # (batch_size,)
-            encoded_covars_mixup = tensors[covar + '_mixup'].view(-1, )  # (batch_size,)
-            covars_dict[covar] = encoded_covars
-            covars_dict[covar + '_mixup'] = encoded_covars_mixup
+            covars_dict[covar] = tensors[covar]  # (batch_size,)
+
+        # mixup inputs are only needed when they contribute to the latent
+        if mixup_lambda < 1.0:
+            perts['mixup'] = tensors[CPA_REGISTRY_KEYS.PERTURBATIONS + '_mixup']
+            perts_doses['mixup'] = tensors[CPA_REGISTRY_KEYS.PERTURBATIONS_DOSAGES + '_mixup']
+            for covar, unique_covars in self.covars_encoder.items():
+                covars_dict[covar + '_mixup'] = tensors[covar + '_mixup']  # (batch_size,)
 
         return dict(
             x=x,
@@ -242,20 +328,30 @@ class CPAModule(BaseModuleClass):
             mixup_lambda: float = 1.0,
             n_samples: int = 1,
     ):
-        batch_size = x.shape[0]
-
         if self.recon_loss in ['nb', 'zinb']:
             # log the input to the variational distribution for numerical stability
-            x_ = torch.log(1 + x)
-            ql, library = self.library_encoder(x_)
+            x_ = torch.log1p(x)
         else:
             x_ = x
-            ql, library = None, None
 
-        if self.variational:
-            qz, z_basal = self.encoder(x_)
-        else:
-            qz, z_basal = None, self.encoder(x_)
+        with torch.autocast(device_type=x_.device.type, dtype=torch.bfloat16, enabled=self.use_amp):
+            if self.recon_loss in ['nb', 'zinb']:
+                ql, library = self.library_encoder(x_)
+            else:
+                ql, library = None, None
+
+            if self.variational:
+                qz, z_basal = self._checkpoint(self.encoder, x_)
+            else:
+                qz, z_basal = None, self._checkpoint(self.encoder, x_)
+
+        if self.use_amp:
+            # everything downstream of the encoders runs in full precision
+            z_basal = z_basal.float()
+            if qz is not None:
+                qz = Normal(qz.loc.float(), qz.scale.float())
+            if ql is not None:
+                ql, library = Normal(ql.loc.float(), ql.scale.float()), library.float()
 
         if self.variational and n_samples > 1:
             sampled_z = qz.sample((n_samples,))
@@ -263,21 +359,31 @@ class CPAModule(BaseModuleClass):
             if self.recon_loss in ['nb', 'zinb']:
                 library = ql.sample((n_samples,))
 
-        z_pert_true = self.pert_network(perts['true'], perts_doses['true'])
+        pert_ids, pert_doses = perts['true'], perts_doses['true']
+        covars = None
+        if len(self.covars_encoder) > 0:
+            covars = torch.stack([covars_dict[covar] for covar in self.covars_encoder.keys()], dim=-1)
+
         if mixup_lambda < 1.0:
-            z_pert_mixup = self.pert_network(perts['mixup'], perts_doses['mixup'])
+            # true and mixup inputs go through the perturbation network in a single pass
+            pert_ids = torch.cat([pert_ids, perts['mixup']], dim=0)
+            pert_doses = torch.cat([pert_doses, perts_doses['mixup']], dim=0)
+            if covars is not None:
+                covars_mixup = torch.stack([covars_dict[covar + '_mixup'] for covar in self.covars_encoder.keys()],
+                                           dim=-1)
+                covars = torch.cat([covars, covars_mixup], dim=0)  # 2 * batch_size, n_covars
+
+        z_pert, z_covs = self.pert_network(pert_ids, pert_doses, covars)
+
+        if mixup_lambda < 1.0:
+            z_pert_true, z_pert_mixup = z_pert.chunk(2, dim=0)
             z_pert = mixup_lambda * z_pert_true + (1. - mixup_lambda) * z_pert_mixup
-        else:
-            z_pert = z_pert_true
+            if z_covs is not None:
+                z_covs_true, z_covs_mixup = z_covs.chunk(2, dim=0)
+                z_covs = mixup_lambda * z_covs_true + (1. - mixup_lambda) * z_covs_mixup
 
-        z_covs = torch.zeros_like(z_basal)  # ([n_samples,] batch_size, n_latent)
-        for covar, encoder in self.covars_encoder.items():
-            z_cov = self.covars_embeddings[covar](covars_dict[covar].long())
-            if len(encoder) > 1:
-                z_cov_mixup = self.covars_embeddings[covar](covars_dict[covar + '_mixup'].long())
-                z_cov = mixup_lambda * z_cov + (1. - mixup_lambda) * z_cov_mixup
-            z_cov = z_cov.view(batch_size, self.n_latent)  # batch_size, n_latent
-            z_covs += z_cov
+        if z_covs is None:
+            z_covs = self._zero.expand_as(z_basal)  # ([n_samples,] batch_size, n_latent), not materialized
 
         z = z_basal + z_pert + z_covs
 
@@ -285,13 +391,24 @@ class CPAModule(BaseModuleClass):
             z=z,
             z_basal=z_basal,
             z_covs=z_covs,
-            z_pert=z_pert.sum(dim=1),
+            z_pert=z_pert,
             library=library,
             qz=qz,
             ql=ql,
             mixup_lambda=mixup_lambda,
         )
 
+    def _get_px_r(self):
+        """Returns the inverse dispersion, reused across no-grad calls until `px_r` is updated"""
+        if torch.is_grad_enabled():
+            return torch.exp(self.px_r)
+
+        version = (self.px_r.data_ptr(), self.px_r._version)
+        if self._px_r_cache is None or self._px_r_cache[0] != version:
+            self._px_r_cache = (version, torch.exp(self.px_r))
+
+        return self._px_r_cache[1]
+
     def _get_generative_input(self, tensors, inference_outputs, **kwargs):
         z = inference_outputs["z"]
         library = inference_outputs['library']
@@ -307,33 +424,38 @@ class CPAModule(BaseModuleClass):
             z,
             library=None,
     ):
-        if self.recon_loss == 'nb':
-            px_scale, _, px_rate, px_dropout = self.decoder("gene", z, library)
-            px_r = torch.exp(self.px_r)
-
-            px = NegativeBinomial(mu=px_rate, theta=px_r)
-
-        elif self.recon_loss == 'zinb':
-            px_scale, _, px_rate, px_dropout = self.decoder("gene", z, library)
-            px_r = torch.exp(self.px_r)
-
-            px = ZeroInflatedNegativeBinomial(mu=px_rate, theta=px_r, zi_logits=px_dropout)
+        with torch.autocast(device_type=z.device.type, dtype=torch.bfloat16, enabled=self.use_amp):
+            if self.recon_loss in ['nb', 'zinb']:
+                px_scale, _, px_rate, px_dropout = self._checkpoint(self.decoder, "gene", z, library)
+            else:
+                px_mean, px_var, x_pred = self._checkpoint(self.decoder, z)
 
+        # likelihoods are evaluated in full precision, directly from their parameters
+        pl = None
+        pz = Normal(self._zero, self._one)  # broadcasts against qz in the KL
+        if self.recon_loss in ['nb', 'zinb']:
+            outputs = dict(px_rate=px_rate.float(), px_r=self._get_px_r(), pz=pz, pl=pl)
+            if self.recon_loss == 'zinb':
+                outputs['px_dropout'] = px_dropout.float()
         else:
-            px_mean, px_var, x_pred = self.decoder(z)
+            outputs = dict(px_mean=px_mean.float(), px_var=px_var.float(), pz=pz, pl=pl)
 
-            px = Normal(loc=px_mean, scale=px_var.sqrt())
-
-        pl = None
-        pz = Normal(torch.zeros_like(z), torch.ones_like(z))
-        return dict(px=px, pz=pz, pl=pl)
+        return outputs
 
     def loss(self, tensors, inference_outputs, generative_outputs):
         """Computes the reconstruction loss (AE) or the ELBO (VAE)"""
         x = tensors[CPA_REGISTRY_KEYS.X_KEY]
 
-        px = generative_outputs['px']
-        recon_loss = -px.log_prob(x).sum(dim=-1).mean()
+        if self.recon_loss == 'nb':
+            log_px = nb_log_prob(x, generative_outputs['px_rate'], generative_outputs['px_r'])
+        elif self.recon_loss == 'zinb':
+            log_px = zinb_log_prob(x, generative_outputs['px_rate'], generative_outputs['px_r'],
+                                   generative_outputs['px_dropout'])
+        else:
+            px = Normal(loc=generative_outputs['px_mean'], scale=generative_outputs['px_var'].sqrt())
+            log_px = px.log_prob(x)
+
+        recon_loss = -log_px.sum(dim=-1).mean()
 
         if self.variational:
             qz = inference_outputs["qz"]
@@ -346,76 +468,101 @@ class CPAModule(BaseModuleClass):
 
         return recon_loss, kl_loss
 
-    def r2_metric(self, tensors, inference_outputs, generative_outputs, mode: str = 'lfc'):
-        mode = mode.lower()
-        assert mode in ['direct']
+    def r2_statistics(self, tensors, generative_outputs):
+        """Computes the per-gene sums from which `r2_metric` is derived, so that it can be accumulated over batches.
 
+        Returns a float64 tensor of shape (4, n_genes) holding the sums of the observed values, of their squares,
+        and of the predicted means and variances (gauss) or of the predictions and their squares (nb, zinb).
+        """
         x = tensors[CPA_REGISTRY_KEYS.X_KEY]  # batch_size, n_genes
 
-        r2_mean = torch.tensor(0.0, device=x.device)
-        r2_var = torch.tensor(0.0, device=x.device)
-
-        px = generative_outputs['px']
         if self.recon_loss == 'gauss':
-            x_pred_mean = px.loc
-            x_pred_var = px.scale ** 2
+            preds = [generative_outputs['px_mean'].clamp(-1e3, 1e3), generative_outputs['px_var'].clamp(-1e3, 1e3)]
+        else:
+            x = torch.log1p(x)
+            x_pred = torch.log1p(generative_outputs['px_rate']).clamp(-1e3, 1e3)
+            preds = [x_pred, x_pred.pow(2)]
 
-            if CPA_REGISTRY_KEYS.DEG_MASK_R2 in tensors.keys():
-                deg_mask = tensors[f'{CPA_REGISTRY_KEYS.DEG_MASK_R2}']
+        if CPA_REGISTRY_KEYS.DEG_MASK_R2 in tensors.keys():
+            deg_mask = tensors[CPA_REGISTRY_KEYS.DEG_MASK_R2]
 
-                x *= deg_mask
-                x_pred_mean *= deg_mask
-                x_pred_var *= deg_mask
+            x = x * deg_mask
+            preds = [pred * deg_mask for pred in preds]
 
-            x_pred_mean = torch.nan_to_num(x_pred_mean, nan=0, posinf=1e3, neginf=-1e3)
-            x_pred_var = torch.nan_to_num(x_pred_var, nan=0, posinf=1e3, neginf=-1e3)
+        x = x.double()
+        return torch.stack([x.sum(0), x.pow(2).sum(0)] + [pred.double().sum(0) for pred in preds])
 
-            r2_mean = torch.nan_to_num(self.metrics['r2_score'](x_pred_mean.mean(0), x.mean(0)),
-                                       nan=0.0).item()
-            r2_var = torch.nan_to_num(self.metrics['r2_score'](x_pred_var.mean(0), x.var(0)),
-                                      nan=0.0).item()
+    def r2_from_statistics(self, statistics, n_obs: int):
+        """Computes the R2 scores of the per-gene means and variances from the sums of `r2_statistics`"""
+        x_sum, x_sq_sum, pred_sum, pred_sq_sum = statistics
+        ddof = max(n_obs - 1, 1)
 
-        elif self.recon_loss in ['nb', 'zinb']:
-            x = torch.log(1 + x)
-            x_pred = px.mu
-            x_pred = torch.log(1 + x_pred)
+        x_mean = x_sum / n_obs
+        x_var = (x_sq_sum - n_obs * x_mean.pow(2)) / ddof
 
-            x_pred = torch.nan_to_num(x_pred, nan=0, posinf=1e3, neginf=-1e3)
+        pred_mean = pred_sum / n_obs
+        if self.recon_loss == 'gauss':
+            # the decoder predicts the variance directly, it is averaged like the mean
+            pred_var = pred_sq_sum / n_obs
+        else:
+            pred_var = (pred_sq_sum - n_obs * pred_mean.pow(2)) / ddof
 
-            if CPA_REGISTRY_KEYS.DEG_MASK_R2 in tensors.keys():
-                deg_mask = tensors[f'{CPA_REGISTRY_KEYS.DEG_MASK_R2}']
+        # clamping does not map NaN, a NaN prediction would otherwise propagate into `cpa_metric`
+        r2_mean = torch.nan_to_num(r2_score(pred_mean.float(), x_mean.float()), nan=0.0)
+        r2_var = torch.nan_to_num(r2_score(pred_var.float(), x_var.float()), nan=0.0)
 
-                x *= deg_mask
-                x_pred *= deg_mask
+        return r2_mean, r2_var
 
-            r2_mean = torch.nan_to_num(self.metrics['r2_score'](x_pred.mean(0), x.mean(0)),
-                                       nan=0.0).item()
-            r2_var = torch.nan_to_num(self.metrics['r2_score'](x_pred.var(0), x.var(0)),
-                                      nan=0.0).item()
+    def r2_metric(self, tensors, inference_outputs, generative_outputs, mode: str = 'lfc'):
+        mode = mode.lower()
+        assert mode in ['direct']
 
-        return r2_mean, r2_var
+        statistics = self.r2_statistics(tensors, generative_outputs)
 
-    def disentanglement(self, tensors, inference_outputs, generative_outputs, linear=True):
-        z_basal = inference_outputs['z_basal'].detach().cpu().numpy()
-        z = inference_outputs['z'].detach().cpu().numpy()
+        return self.r2_from_statistics(statistics, tensors[CPA_REGISTRY_KEYS.X_KEY].shape[0])
 
-        perturbations = tensors[CPA_REGISTRY_KEYS.PERTURBATION_KEY].view(-1, )
-        perturbations_names = perturbations.detach().cpu().numpy()
+    def disentanglement(self, tensors, inference_outputs, generative_outputs, linear=True,
+                        use_gpu_knn: Optional[bool] = None, max_cells: Optional[int] = 10000):
+        """Computes the KNN purity of perturbations and covariates in the basal and final latent spaces.
 
-        knn_basal = knn_purity(z_basal, perturbations_names.ravel(),
-                               n_neighbors=min(perturbations_names.shape[0] - 1, 30))
-        knn_after = knn_purity(z, perturbations_names.ravel(),
-                               n_neighbors=min(perturbations_names.shape[0] - 1, 30))
+        Neighbours are found once per latent space and every target is scored from them. If there are more
+        than `max_cells` cells, a fixed random subset of `max_cells` of them is scored.
 
-        for covar, unique_covars in self.covars_encoder.items():
-            if len(unique_covars) > 1:
-                target_covars = tensors[f'{covar}'].detach().cpu().numpy()
+        If `use_gpu_knn` is `True` (the default when the latents are on GPU), neighbours are computed on the
+        device of the latents and the scores are returned as tensors. Otherwise, the latents are moved to host
+        and scikit-learn is used.
+        """
+        z_basal = inference_outputs['z_basal'].detach()
+        z = inference_outputs['z'].detach()
+
+        targets = [tensors[CPA_REGISTRY_KEYS.PERTURBATION_KEY]]
+        targets += [tensors[covar] for covar, unique_covars in self.covars_encoder.items() if len(unique_covars) > 1]
+        targets = [target.detach().view(-1, ) for target in targets]
+
+        if max_cells is not None and z.shape[0] > max_cells:
+            # the same cells are scored every epoch, so that scores stay comparable
+            subset = torch.randperm(z.shape[0], generator=torch.Generator().manual_seed(0))[:max_cells]
+            subset = subset.to(z.device)
+            z_basal, z = z_basal[subset], z[subset]
+            targets = [target[subset] for target in targets]
+
+        if use_gpu_knn is None:
+            use_gpu_knn = z.is_cuda
+        if use_gpu_knn:
+            neighbors, purity = knn_indices_gpu, neighbors_purity_gpu
+        else:
+            neighbors, purity = knn_indices, neighbors_purity
+            z_basal, z = z_basal.cpu().numpy(), z.cpu().numpy()
+            targets = [target.cpu().numpy() for target in targets]
 
-                knn_basal += knn_purity(z_basal, target_covars.ravel(),
-                                        n_neighbors=min(target_covars.shape[0] - 1, 30))
+        n_neighbors = min(z.shape[0] - 1, 30)
+        indices_basal = neighbors(z_basal, n_neighbors=n_neighbors)
+        indices_after = neighbors(z, n_neighbors=n_neighbors)
 
-                knn_after += knn_purity(z, target_covars.ravel(),
-                                        n_neighbors=min(target_covars.shape[0] - 1, 30))
+        knn_basal, knn_after = 0.0, 0.0
+        for target in targets:
+            knn_basal += purity(indices_basal, target)
+            knn_after += purity(indices_after, target)
 
         return knn_basal, knn_after
 
@@ -438,14 +585,12 @@ class CPAModule(BaseModuleClass):
             compute_loss=False,
         )
 
-        px = generative_outputs['px']
-
         if self.recon_loss == 'gauss':
-            output_key = 'loc'
+            output_key = 'px_mean'
         else:
-            output_key = 'mu'
+            output_key = 'px_rate'
 
-        output = getattr(px, output_key)
+        output = generative_outputs[output_key]
 
         return output
 
@@ -454,4 +599,6 @@ class CPAModule(BaseModuleClass):
         drugs = inputs['perts']
         doses = inputs['perts_doses']
 
-        return self.pert_network(drugs, doses)
+        z_pert, _ = self.pert_network(drugs, doses)
+
+        return z_pert
@@ -1,12 +1,15 @@
 import math
-
-from collections import defaultdict
+import sys
+from collections.abc import Mapping
+from itertools import chain
+from types import MappingProxyType
 from typing import Union
 
 import torch
 from scvi.module import Classifier
 from torch import nn
 from torch.optim.lr_scheduler import StepLR
+from pytorch_lightning.strategies import DDPStrategy
 
 from scvi.train import TrainingPlan
 
@@ -18,6 +21,109 @@ from ._utils import CPA_REGISTRY_KEYS, FocalLoss
 from typing import Optional
 
 
+def _nonzero_mean(values: torch.Tensor) -> torch.Tensor:
+    """Averages the non-zero entries of each column of `values` (n_steps, n_keys)"""
+    mask = values != 0.0
+    return (values * mask).sum(dim=0) / mask.sum(dim=0)
+
+
+# scripted so that the masking and reductions are fused; `use_compile` swaps in a `torch.compile`d version
+_nonzero_mean_scripted = torch.jit.script(_nonzero_mean)
+
+
+def _get_reduce_outputs(use_compile: bool = False):
+    """Returns the epoch-end reduction of the step buffers, compiled lazily if `use_compile` is supported"""
+    if use_compile and hasattr(torch, 'compile') and sys.platform != 'win32':
+        return torch.compile(_nonzero_mean, dynamic=True)
+
+    return _nonzero_mean_scripted
+
+
+class _StepBuffer:
+    """Per-epoch (n_steps, n_keys) device tensor holding one row of step values per batch"""
+
+    def __init__(self, keys, reduce_outputs=_nonzero_mean):
+        self.keys = tuple(keys)
+        self._reduce_outputs = reduce_outputs
+        self._values = None
+        self._ptr = 0
+
+    def reset(self, n_steps, like: torch.Tensor):
+        n_steps = int(n_steps) if math.isfinite(n_steps) and n_steps > 0 else 64
+        self._values = like.new_zeros((n_steps, len(self.keys)))
+        self._ptr = 0
+
+    def write(self, results: dict):
+        if self._ptr == len(self._values):
+            self._values = torch.cat([self._values, torch.zeros_like(self._values)])
+
+        self._values[self._ptr] = torch.stack([results[key] for key in self.keys])
+        self._ptr += 1
+
+    def nonzero_means(self):
+        """Averages the non-zero step values of each key, syncing with the device once per epoch"""
+        means = self._reduce_outputs(self._values[:self._ptr])
+        return dict(zip(self.keys, means.cpu().tolist()))
+
+
+class _EpochHistory(Mapping):
+    """Per-epoch metric history backed by growable NumPy arrays, one row per train/valid epoch.
+
+    Reads like the former `dict` of lists: `history[key]` is the column of `key` ('epoch', 'mode' or a metric)
+    as a NumPy array, and iterating yields the column names.
+    """
+
+    def __init__(self, keys, capacity: int = 64):
+        self.metric_keys = list(keys)
+        self._columns = {key: i for i, key in enumerate(self.metric_keys)}
+        self._values = np.full((capacity, len(self.metric_keys)), np.nan, dtype=np.float64)
+        self._epochs = np.empty(capacity, dtype=np.int64)
+        self._modes = np.empty(capacity, dtype='U5')
+        self._ptr = 0
+
+    @property
+    def n_epochs(self):
+        """Number of recorded train/valid epochs"""
+        return self._ptr
+
+    def __iter__(self):
+        yield 'epoch'
+        yield 'mode'
+        yield from self.metric_keys
+
+    def __len__(self):
+        return len(self.metric_keys) + 2
+
+    def __getitem__(self, key):
+        if key == 'epoch':
+            return self._epochs[:self._ptr]
+        if key == 'mode':
+            return self._modes[:self._ptr]
+        return self._values[:self._ptr, self._columns[key]]
+
+    def _grow(self):
+        capacity = 2 * len(self._epochs)
+        values = np.full((capacity, len(self.metric_keys)), np.nan, dtype=np.float64)
+        values[:self._ptr] = self._values[:self._ptr]
+        self._values = values
+        self._epochs = np.resize(self._epochs, capacity)
+        self._modes = np.resize(self._modes, capacity)
+
+    def append(self, values: dict, epoch: int, mode: str):
+        if self._ptr == len(self._epochs):
+            self._grow()
+
+        row = self._values[self._ptr]
+        for key, value in values.items():
+            row[self._columns[key]] = value
+        self._epochs[self._ptr] = epoch
+        self._modes[self._ptr] = mode
+        self._ptr += 1
+
+    def to_dict(self):
+        return {key: self[key].copy() for key in self}
+
+
 class CPATrainingPlan(TrainingPlan):
     def __init__(
             self,
@@ -52,8 +158,15 @@ class CPATrainingPlan(TrainingPlan):
             gradient_clip_value: Optional[float] = 3.0,
             drug_weights: Optional[list] = None,
             adv_loss: Optional[str] = 'focal',
+            use_compile: bool = False,
     ):
-        """Training plan for the CPA model"""
+        """Training plan for the CPA model
+
+        Step-based schedules (`n_steps_pretrain_ae`, `n_steps_kl_warmup`, `n_steps_adv_warmup`) count training
+        batches in `n_train_steps`, which is saved in checkpoints. They no longer follow `global_step`: all
+        parameter groups share one optimizer, so `global_step` (and the trainer's `max_steps`) counts one step
+        per batch, or two if `adv_steps=None` once adversarial training has started.
+        """
         super().__init__(
             module=module,
             lr=lr,
@@ -69,6 +182,16 @@ class CPATrainingPlan(TrainingPlan):
         )
 
         self.automatic_optimization = False
+        # step-based schedules (`n_steps_*`) count training batches, not optimizer steps
+        self.n_train_steps = 0
+
+        self.use_compile = use_compile
+        # compiled references are kept on the plan, the user's module is left untouched
+        self._forward, self._loss = self.module.forward, self.module.loss
+        if use_compile:
+            # shapes are static, so the last incomplete batch of an epoch compiles its own graph
+            self._forward = torch.compile(self._forward, mode='reduce-overhead', dynamic=False)
+            self._loss = torch.compile(self._loss, mode='reduce-overhead', dynamic=False)
 
         self.wd = wd
 
@@ -86,6 +209,9 @@ class CPATrainingPlan(TrainingPlan):
         self.n_epochs_verbose = n_epochs_verbose
 
         self.adv_steps = adv_steps
+        # adversary-only steps within one period of the schedule, e.g. (True, False, False) for adv_steps=3
+        self._adv_schedule = tuple(step % adv_steps == 0 for step in range(adv_steps)) \
+            if adv_steps is not None else None
 
         self.reg_adv = reg_adv
         self.pen_adv = pen_adv
@@ -106,9 +232,41 @@ class CPATrainingPlan(TrainingPlan):
                         'r2_mean', 'r2_var',
                         'adv_loss', 'penalty_adv', 'adv_perts', 'acc_perts', 'penalty_perts']
 
-        self.epoch_history = defaultdict(list)
+        self.register_buffer('_zero', torch.zeros(()), persistent=False)
+        # parameter groups of the optimizer updated by the model and adversary steps
+        self._model_groups = (0, 1)
+        self._adv_groups = (2,)
         self.n_adv_perts = n_adv_perts
 
+        # per-covariate result keys, built once instead of formatted at every step
+        self._covar_keys = tuple(self.covars_encoder.keys())
+        self._adv_covar_keys = tuple(f'adv_{covar}' for covar in self._covar_keys)
+        self._acc_covar_keys = tuple(f'acc_{covar}' for covar in self._covar_keys)
+        self._pen_covar_keys = tuple(f'penalty_{covar}' for covar in self._covar_keys)
+        # covariates with a single value have no adversary and are not tracked
+        self._tracked_acc_covar_keys = tuple(key for key, unique_covars in
+                                             zip(self._acc_covar_keys, self.covars_encoder.values())
+                                             if len(unique_covars) > 1)
+
+        history_keys = list(self.metrics)
+        for covar, unique_covars in self.covars_encoder.items():
+            if len(unique_covars) > 1:
+                history_keys += [f'adv_{covar}', f'penalty_{covar}', f'acc_{covar}']
+        self.epoch_history = _EpochHistory(history_keys)
+        reduce_outputs = _get_reduce_outputs(use_compile)
+        self._train_steps = _StepBuffer((key for key in history_keys if key not in ['disnt_basal', 'disnt_after']),
+                                        reduce_outputs)
+        # r2 and disentanglement are computed once per validation epoch over the cached outputs
+        self._val_epoch_keys = ('r2_mean', 'r2_var', 'disnt_basal', 'disnt_after')
+        self._val_steps = _StepBuffer((key for key in history_keys if key not in self._val_epoch_keys), reduce_outputs)
+        # labels of the disentanglement targets, covariates with a single value are not scored
+        self._val_label_keys = (CPA_REGISTRY_KEYS.PERTURBATION_KEY,) + tuple(
+            covar for covar, unique_covars in self.covars_encoder.items() if len(unique_covars) > 1)
+        self._val_cache = None
+        self._val_r2_statistics = None
+        self._val_n_obs = 0
+        self._zero_results = None
+
         self.perturbation_classifier = Classifier(
             n_input=self.module.n_latent,
             n_labels=n_adv_perts,
@@ -125,8 +283,8 @@ class CPATrainingPlan(TrainingPlan):
             {
                 key: Classifier(n_input=self.module.n_latent,
                                 n_labels=len(unique_covars),
-                                n_hidden=self.n_hidden_adv,
-                                n_layers=self.n_layers_adv,
+                                n_hidden=n_hidden_adv,
+                                n_layers=n_layers_adv,
                                 use_batch_norm=use_batch_norm_adv,
                                 use_layer_norm=use_layer_norm_adv,
                                 dropout_rate=dropout_rate_adv,
@@ -149,11 +307,25 @@ class CPATrainingPlan(TrainingPlan):
             self.adv_loss_drugs = FocalLoss(alpha=self.drug_weights, gamma=self.gamma, reduction='mean')
             self.adv_loss_fn = FocalLoss(gamma=self.gamma, reduction='mean')
         
+    @property
+    def kl_weight(self):
+        """Scaling factor on the KL divergence, warmed up over epochs or training batches"""
+        max_weight = getattr(self, 'max_kl_weight', 1.0)
+        min_weight = getattr(self, 'min_kl_weight', None) or 0.0
+        if self.n_epochs_kl_warmup:
+            proportion = self.current_epoch / self.n_epochs_kl_warmup
+        elif self.n_steps_kl_warmup:
+            proportion = self.n_train_steps / self.n_steps_kl_warmup
+        else:
+            return max_weight
+
+        return min(max_weight, min_weight + (max_weight - min_weight) * proportion)
+
     @property
     def adv_lambda(self):
         slope = self.reg_adv
         if self.n_steps_adv_warmup:
-            global_step = self.global_step
+            global_step = self.n_train_steps
 
             if self.n_steps_pretrain_ae:
                  global_step -= self.n_steps_pretrain_ae
@@ -197,7 +369,7 @@ class CPATrainingPlan(TrainingPlan):
     @property
     def do_start_adv_training(self):
         if self.n_steps_pretrain_ae:
-            return self.global_step > self.n_steps_pretrain_ae
+            return self.n_train_steps > self.n_steps_pretrain_ae
         elif self.n_epochs_pretrain_ae:
             return self.current_epoch > self.n_epochs_pretrain_ae
         else:
@@ -209,12 +381,11 @@ class CPATrainingPlan(TrainingPlan):
             z_basal = z_basal.requires_grad_(True)
 
         covars_dict = dict()
-        for covar, unique_covars in self.covars_encoder.items():
-            encoded_covars = tensors[covar].view(-1, )  # (batch_size,)
-            covars_dict[covar] = encoded_covars
+        for covar in self._covar_keys:
+            covars_dict[covar] = tensors[covar]  # (batch_size,)
 
         covars_pred = {}
-        for covar in self.covars_encoder.keys():
+        for covar in self._covar_keys:
             if self.covars_classifiers[covar] is not None:
                 covar_pred = self.covars_classifiers[covar](z_basal)
                 covars_pred[covar] = covar_pred
@@ -224,37 +395,38 @@ class CPATrainingPlan(TrainingPlan):
         adv_results = {}
 
         # Classification losses for different covariates
-        for covar, covars in self.covars_encoder.items():
-            adv_results[f'adv_{covar}'] = mixup_lambda * self.adv_loss_fn(
+        for (covar, covars), adv_key, acc_key in zip(self.covars_encoder.items(),
+                                                     self._adv_covar_keys, self._acc_covar_keys):
+            adv_results[adv_key] = mixup_lambda * self.adv_loss_fn(
                 covars_pred[covar],
-                covars_dict[covar].long(),
+                covars_dict[covar],
             ) if covars_pred[covar] is not None else torch.as_tensor(0.0).to(self.device) + (
                     1. - mixup_lambda) * self.adv_loss_fn(
                 covars_pred[covar],
-                covars_dict[covar + '_mixup'].long(),
+                covars_dict[covar + '_mixup'],
             ) if covars_pred[covar] is not None else torch.as_tensor(0.0).to(self.device)
-            adv_results[f'acc_{covar}'] = accuracy(
-                covars_pred[covar].argmax(1), covars_dict[covar].long(), task='multiclass',
+            adv_results[acc_key] = accuracy(
+                covars_pred[covar].argmax(1), covars_dict[covar], task='multiclass',
                 num_classes=len(covars)) \
                 if covars_pred[covar] is not None else torch.as_tensor(0.0).to(self.device)
 
-        adv_results['adv_loss'] = sum([adv_results[f'adv_{key}'] for key in self.covars_encoder.keys()])
+        adv_results['adv_loss'] = sum([adv_results[key] for key in self._adv_covar_keys])
 
-        perturbations = tensors[CPA_REGISTRY_KEYS.PERTURBATION_KEY].view(-1, )
-        perturbations_mixup = tensors[CPA_REGISTRY_KEYS.PERTURBATION_KEY + '_mixup'].view(-1, )
+        perturbations = tensors[CPA_REGISTRY_KEYS.PERTURBATION_KEY]
+        perturbations_mixup = tensors[CPA_REGISTRY_KEYS.PERTURBATION_KEY + '_mixup']
 
         perturbations_pred = self.perturbation_classifier(z_basal)
 
         adv_results['adv_perts'] = mixup_lambda * self.adv_loss_drugs(perturbations_pred,
-                                                                      perturbations.long()) + (
+                                                                      perturbations) + (
                                            1. - mixup_lambda) * self.adv_loss_drugs(perturbations_pred,
-                                                                                    perturbations_mixup.long())
+                                                                                    perturbations_mixup)
 
         adv_results['acc_perts'] = mixup_lambda * accuracy(
-            perturbations_pred.argmax(1), perturbations.long().view(-1, ), average='macro',
+            perturbations_pred.argmax(1), perturbations, average='macro',
             num_classes=self.n_adv_perts, task='multiclass',
         ) + (1. - mixup_lambda) * accuracy(
-            perturbations_pred.argmax(1), perturbations_mixup.long().view(-1, ), average='macro',
+            perturbations_pred.argmax(1), perturbations_mixup, average='macro',
             num_classes=self.n_adv_perts, task='multiclass',
         )
 
@@ -262,8 +434,8 @@ class CPATrainingPlan(TrainingPlan):
 
         if compute_penalty:
             # Penalty losses
-            for covar in self.covars_encoder.keys():
-                adv_results[f'penalty_{covar}'] = (
+            for covar, pen_key in zip(self._covar_keys, self._pen_covar_keys):
+                adv_results[pen_key] = (
                     torch.autograd.grad(
                         covars_pred[covar].sum(),
                         z_basal,
@@ -273,7 +445,7 @@ class CPATrainingPlan(TrainingPlan):
                     )[0].pow(2).mean()
                 ) if covars_pred[covar] is not None else torch.as_tensor(0.0).to(self.device)
 
-            adv_results['penalty_adv'] = sum([adv_results[f'penalty_{covar}'] for covar in self.covars_encoder.keys()])
+            adv_results['penalty_adv'] = sum([adv_results[key] for key in self._pen_covar_keys])
 
             adv_results['penalty_perts'] = (
                 torch.autograd.grad(
@@ -287,304 +459,326 @@ class CPATrainingPlan(TrainingPlan):
 
             adv_results['penalty_adv'] += adv_results['penalty_perts']
         else:
-            for covar in self.covars_encoder.keys():
-                adv_results[f'penalty_{covar}'] = torch.as_tensor(0.0).to(self.device)
-
-            adv_results['penalty_perts'] = torch.as_tensor(0.0).to(self.device)
-            adv_results['penalty_adv'] = torch.as_tensor(0.0).to(self.device)
+            adv_results.update(self._get_zero_results()[1])
 
         return adv_results
+
+    def _get_zero_results(self):
+        """Returns read-only zero adversarial results and penalties, rebuilt when the plan changes device"""
+        if self._zero_results is None or self._zero_results[0]['adv_loss'] is not self._zero:
+            penalties = dict.fromkeys(('penalty_adv', 'penalty_perts') + self._pen_covar_keys, self._zero)
+            adv_results = dict.fromkeys(('adv_loss', 'cycle_loss', 'adv_perts', 'acc_perts')
+                                        + self._adv_covar_keys + self._acc_covar_keys, self._zero)
+            adv_results.update(penalties)
+            self._zero_results = (MappingProxyType(adv_results), MappingProxyType(penalties))
+
+        return self._zero_results
     
     def configure_optimizers(self):
-        ae_params = list(filter(lambda p: p.requires_grad, self.module.encoder.parameters())) + \
-                    list(filter(lambda p: p.requires_grad, self.module.decoder.parameters())) + \
-                    list(filter(lambda p: p.requires_grad, self.module.pert_network.pert_embedding.parameters())) + \
-                    list(filter(lambda p: p.requires_grad, self.module.covars_embeddings.parameters()))
-
+        ae_modules = [self.module.encoder, self.module.decoder, self.module.pert_network.embedding]
+        extra_ae_params = []
         if self.module.recon_loss in ['zinb', 'nb']:
-            ae_params += list(filter(lambda p: p.requires_grad, self.module.library_encoder.parameters())) + \
-                         [self.module.px_r]
-
-        optimizer_autoencoder = torch.optim.Adam(
-            ae_params,
-            lr=self.lr,
-            weight_decay=self.wd)
-
-        scheduler_autoencoder = StepLR(optimizer_autoencoder, step_size=self.step_size_lr, gamma=0.9)
-
-        doser_params = list(filter(lambda p: p.requires_grad, self.module.pert_network.dosers.parameters()))
-        optimizer_doser = torch.optim.Adam(
-            doser_params, lr=self.doser_lr, weight_decay=self.doser_wd,
+            ae_modules.append(self.module.library_encoder)
+            extra_ae_params.append(self.module.px_r)
+
+        self._ae_params = [p for p in chain(*(m.parameters() for m in ae_modules), extra_ae_params)
+                           if p.requires_grad]
+        self._doser_params = [p for p in self.module.pert_network.dosers.parameters() if p.requires_grad]
+        self._adv_params = [p for p in chain(self.perturbation_classifier.parameters(),
+                                             self.covars_classifiers.parameters()) if p.requires_grad]
+
+        # one optimizer with a parameter group per sub-network (autoencoder, doser, adversaries)
+        optimizer = torch.optim.Adam(
+            [
+                {'params': self._ae_params, 'lr': self.lr, 'weight_decay': self.wd},
+                {'params': self._doser_params, 'lr': self.doser_lr, 'weight_decay': self.doser_wd},
+                {'params': self._adv_params, 'lr': self.adv_lr, 'weight_decay': self.adv_wd},
+            ],
+            # Lightning cannot clip the gradients of optimizers that unscale them internally under AMP
+            fused=self.device.type == 'cuda' and not self.do_clip_grad,
         )
-        scheduler_doser = StepLR(optimizer_doser, step_size=self.step_size_lr, gamma=0.9)
 
-        adv_params = list(filter(lambda p: p.requires_grad, self.perturbation_classifier.parameters())) + \
-                     list(filter(lambda p: p.requires_grad, self.covars_classifiers.parameters()))
+        if self.step_size_lr is not None:
+            scheduler = StepLR(optimizer, step_size=self.step_size_lr, gamma=0.9)
+            return [optimizer], [scheduler]
+        else:
+            return optimizer
+
+    def _optimizer_step(self, opt, groups):
+        """Steps the parameter groups in `groups`, dropping the gradients of the other groups"""
+        param_groups = opt.param_groups
+        for idx, group in enumerate(param_groups):
+            if idx not in groups:
+                for p in group['params']:
+                    p.grad = None
+
+        if self.do_clip_grad:
+            # `clip_gradients` covers every parameter of the optimizer, so each group is clipped on its own
+            # while the gradients of the other active groups are set aside
+            for idx in groups:
+                others = [(p, p.grad) for other in groups if other != idx for p in param_groups[other]['params']]
+                for p, _ in others:
+                    p.grad = None
+                self.clip_gradients(opt,
+                                    gradient_clip_val=self.gradient_clip_value,
+                                    gradient_clip_algorithm="norm")
+                for p, grad in others:
+                    p.grad = grad
+
+        opt.step()
 
-        optimizer_adversaries = torch.optim.Adam(
-            adv_params,
-            lr=self.adv_lr,
-            weight_decay=self.adv_wd)
-        scheduler_adversaries = StepLR(optimizer_adversaries, step_size=self.step_size_lr, gamma=0.9)
+    def _adversary_backward(self, adv_loss):
+        """Backpropagates `adv_loss`, averaging only the adversaries' gradients across DDP processes"""
+        strategy = self.trainer.strategy
+        if not isinstance(strategy, DDPStrategy):
+            self.manual_backward(adv_loss)
+            return
 
-        optimizers = [optimizer_autoencoder, optimizer_doser, optimizer_adversaries]
-        schedulers = [scheduler_autoencoder, scheduler_doser, scheduler_adversaries]
+        # skip DDP's bucketed all-reduce over every parameter and sync the adversaries as one flat tensor
+        with strategy.block_backward_sync():
+            self.manual_backward(adv_loss)
 
-        if self.step_size_lr is not None:
-            return optimizers, schedulers
-        else:
-            return optimizers
+        grads = [p.grad for p in self._adv_params if p.grad is not None]
+        flat_grads = strategy.reduce(torch.cat([grad.reshape(-1) for grad in grads]), reduce_op='mean')
+        for grad, flat_grad in zip(grads, flat_grads.split([grad.numel() for grad in grads])):
+            grad.copy_(flat_grad.view_as(grad))
 
     def training_step(self, batch, batch_idx):
-        opt, opt_doser, opt_adv = self.optimizers()
-
-        mixup_alpha = self.alpha_mixup
+        opt = self.optimizers()
 
-        batch, mixup_lambda = self.module.mixup_data(batch, alpha=mixup_alpha)
+        module = self.module
+        mixup_data, forward, compute_loss, r2_metric = module.mixup_data, self._forward, self._loss, module.r2_metric
+        adversarial_loss, manual_backward = self.adversarial_loss, self.manual_backward
 
-        inf_outputs, gen_outputs = self.module.forward(batch, compute_loss=False,
-                                                       inference_kwargs={
-                                                           'mixup_lambda': mixup_lambda,
-                                                       })
+        mixup_alpha = self.alpha_mixup
 
-        recon_loss, kl_loss = self.module.loss(
-            tensors=batch,
-            inference_outputs=inf_outputs,
-            generative_outputs=gen_outputs,
-        )
+        batch, mixup_lambda = mixup_data(batch, alpha=mixup_alpha)
+
+        # adversary-only steps backpropagate through the classifiers alone,
+        # so the autoencoder forward and reconstruction loss need no graph
+        adv_only_step = self.do_start_adv_training and self._adv_schedule is not None \
+            and self._adv_schedule[batch_idx % self.adv_steps]
+
+        with torch.set_grad_enabled(not adv_only_step):
+            inf_outputs, gen_outputs = forward(batch, compute_loss=False,
+                                               get_inference_input_kwargs={
+                                                   'mixup_lambda': mixup_lambda,
+                                               },
+                                               inference_kwargs={
+                                                   'mixup_lambda': mixup_lambda,
+                                               })
+
+            recon_loss, kl_loss = compute_loss(
+                tensors=batch,
+                inference_outputs=inf_outputs,
+                generative_outputs=gen_outputs,
+            )
 
         if self.do_start_adv_training:
             if self.adv_steps is None:
-                opt.zero_grad()
-                opt_doser.zero_grad()
+                opt.zero_grad(set_to_none=True)
 
                 z_basal = inf_outputs['z_basal']
 
-                adv_results = self.adversarial_loss(tensors=batch,
-                                                    z_basal=z_basal,
-                                                    mixup_lambda=mixup_lambda,
-                                                    compute_penalty=False)
+                adv_results = adversarial_loss(tensors=batch,
+                                               z_basal=z_basal,
+                                               mixup_lambda=mixup_lambda,
+                                               compute_penalty=False)
 
                 loss = recon_loss + self.kl_weight * kl_loss - self.adv_lambda * adv_results['adv_loss']
 
-                self.manual_backward(loss)
+                manual_backward(loss)
 
-                if self.do_clip_grad:
-                    self.clip_gradients(opt,
-                                        gradient_clip_val=self.gradient_clip_value,
-                                        gradient_clip_algorithm="norm")
-                    self.clip_gradients(opt_doser,
-                                        gradient_clip_val=self.gradient_clip_value,
-                                        gradient_clip_algorithm="norm")
-                opt.step()
-                opt_doser.step()
+                self._optimizer_step(opt, self._model_groups)
 
-                opt_adv.zero_grad()
+                opt.zero_grad(set_to_none=True)
 
-                adv_results = self.adversarial_loss(tensors=batch,
-                                                    z_basal=z_basal.detach(),
-                                                    mixup_lambda=mixup_lambda,
-                                                    compute_penalty=True)
+                adv_results = adversarial_loss(tensors=batch,
+                                               z_basal=z_basal.detach(),
+                                               mixup_lambda=mixup_lambda,
+                                               compute_penalty=True)
 
                 adv_loss = adv_results['adv_loss'] + self.pen_adv * adv_results['penalty_adv']
 
-                self.manual_backward(adv_loss)
-
-                if self.do_clip_grad:
-                    self.clip_gradients(opt_adv,
-                                        gradient_clip_val=self.gradient_clip_value,
-                                        gradient_clip_algorithm="norm")
+                self._adversary_backward(adv_loss)
 
-                opt_adv.step()
+                self._optimizer_step(opt, self._adv_groups)
 
-            elif batch_idx % self.adv_steps == 0:
-                opt_adv.zero_grad()
+            elif adv_only_step:
+                opt.zero_grad(set_to_none=True)
 
                 z_basal = inf_outputs['z_basal']
 
-                adv_results = self.adversarial_loss(tensors=batch,
-                                                    z_basal=z_basal.detach(),
-                                                    mixup_lambda=mixup_lambda,
-                                                    compute_penalty=True)
+                adv_results = adversarial_loss(tensors=batch,
+                                               z_basal=z_basal.detach(),
+                                               mixup_lambda=mixup_lambda,
+                                               compute_penalty=True)
 
                 adv_loss = adv_results['adv_loss'] + self.pen_adv * adv_results['penalty_adv']
 
-                self.manual_backward(adv_loss)
+                self._adversary_backward(adv_loss)
 
-                if self.do_clip_grad:
-                    self.clip_gradients(opt_adv,
-                                        gradient_clip_val=self.gradient_clip_value,
-                                        gradient_clip_algorithm="norm")
-
-                opt_adv.step()
+                self._optimizer_step(opt, self._adv_groups)
 
             # Model update
             else:
-                opt.zero_grad()
-                opt_doser.zero_grad()
+                opt.zero_grad(set_to_none=True)
 
                 z_basal = inf_outputs['z_basal']
 
-                adv_results = self.adversarial_loss(tensors=batch,
-                                                    z_basal=z_basal,
-                                                    mixup_lambda=mixup_lambda,
-                                                    compute_penalty=False)
+                adv_results = adversarial_loss(tensors=batch,
+                                               z_basal=z_basal,
+                                               mixup_lambda=mixup_lambda,
+                                               compute_penalty=False)
 
                 loss = recon_loss + self.kl_weight * kl_loss - self.adv_lambda * adv_results['adv_loss']
 
-                self.manual_backward(loss)
+                manual_backward(loss)
 
-                if self.do_clip_grad:
-                    self.clip_gradients(opt,
-                                        gradient_clip_val=self.gradient_clip_value,
-                                        gradient_clip_algorithm="norm")
-                    self.clip_gradients(opt_doser,
-                                        gradient_clip_val=self.gradient_clip_value,
-                                        gradient_clip_algorithm="norm")
-                opt.step()
-                opt_doser.step()
+                self._optimizer_step(opt, self._model_groups)
 
         else:
-            opt.zero_grad()
-            opt_doser.zero_grad()
+            opt.zero_grad(set_to_none=True)
 
             z_basal = inf_outputs['z_basal']
 
-            loss = recon_loss + self.kl_weight * kl_loss
+            adv_results = adversarial_loss(tensors=batch,
+                                           z_basal=z_basal.detach(),
+                                           mixup_lambda=mixup_lambda,
+                                           compute_penalty=True)
 
-            self.manual_backward(loss)
+            # the adversaries only see the detached z_basal, so a single backward over the weighted sum
+            # gives the autoencoder and the adversaries exactly the gradients of their own losses
+            loss = recon_loss + self.kl_weight * kl_loss + \
+                adv_results['adv_loss'] + self.pen_adv * adv_results['penalty_adv']
 
-            if self.do_clip_grad:
-                self.clip_gradients(opt,
-                                    gradient_clip_val=self.gradient_clip_value,
-                                    gradient_clip_algorithm="norm")
-                self.clip_gradients(opt_doser,
-                                    gradient_clip_val=self.gradient_clip_value,
-                                    gradient_clip_algorithm="norm")
-
-            opt.step()
-            opt_doser.step()
+            manual_backward(loss)
 
-            opt_adv.zero_grad()
+            self._optimizer_step(opt, self._model_groups + self._adv_groups)
 
-            adv_results = self.adversarial_loss(tensors=batch,
-                                                z_basal=z_basal.detach(),
-                                                mixup_lambda=mixup_lambda,
-                                                compute_penalty=True)
+        with torch.no_grad():
+            r2_mean, r2_var = r2_metric(batch, inf_outputs, gen_outputs, mode='direct')
 
-            adv_loss = adv_results['adv_loss'] + self.pen_adv * adv_results['penalty_adv']
-
-            self.manual_backward(adv_loss)
-
-            if self.do_clip_grad:
-                self.clip_gradients(opt_adv,
-                                    gradient_clip_val=self.gradient_clip_value,
-                                    gradient_clip_algorithm="norm")
+        # release the forward outputs before the step results are recorded
+        del inf_outputs, gen_outputs, z_basal
 
-            opt_adv.step()
+        # step values stay on device until the end of the epoch
+        results = {
+            **{key: val.detach() for key, val in adv_results.items()},
+            'recon_loss': recon_loss.detach(),
+            'KL': kl_loss.detach(),
+            'r2_mean': r2_mean, 'r2_var': r2_var,
+            'r2_mean_lfc': self._zero, 'r2_var_lfc': self._zero,
+            'cpa_metric': self._zero,
+            'disnt_basal': self._zero, 'disnt_after': self._zero,
+        }
 
-        r2_mean, r2_var = self.module.r2_metric(batch, inf_outputs, gen_outputs, mode='direct')
+        self._train_steps.write(results)
+        self.n_train_steps += 1
 
-        for key, val in adv_results.items():
-            adv_results[key] = val.item()
+    def on_save_checkpoint(self, checkpoint):
+        super().on_save_checkpoint(checkpoint)
+        checkpoint['n_train_steps'] = self.n_train_steps
 
-        results = adv_results.copy()
-        results.update({'recon_loss': recon_loss.item()})
-        results.update({'KL': kl_loss.item()})
+    def on_load_checkpoint(self, checkpoint):
+        super().on_load_checkpoint(checkpoint)
+        # checkpoints saved before the counter existed only have the optimizer step count
+        self.n_train_steps = checkpoint.get('n_train_steps', checkpoint.get('global_step', 0))
 
-        results.update({'r2_mean': r2_mean, 'r2_var': r2_var})
-        results.update({'r2_mean_lfc': 0.0, 'r2_var_lfc': 0.0})
-        results.update({'cpa_metric': 0.0})
-        results.update({'disnt_basal': 0.0, 'disnt_after': 0.0})
-
-        return results
+    def on_train_epoch_start(self):
+        self._train_steps.reset(self.trainer.num_training_batches, like=self._zero)
 
     def training_epoch_end(self, outputs):
-        for key in self.metrics:
-            if key in ['disnt_basal', 'disnt_after']:
-                self.epoch_history[key].append(0.0)
-            else:
-                self.epoch_history[key].append(np.mean([output[key] for output in outputs if output[key] != 0.0]))
+        means = self._train_steps.nonzero_means()
+        means.update({'disnt_basal': 0.0, 'disnt_after': 0.0})
+        self.epoch_history.append(means, epoch=self.current_epoch, mode='train')
 
-        for covar, unique_covars in self.covars_encoder.items():
-            if len(unique_covars) > 1:
-                key1, key2, key3 = f'adv_{covar}', f'penalty_{covar}', f'acc_{covar}'
-                self.epoch_history[key1].append(np.mean([output[key1] for output in outputs if output[key1] != 0.0]))
-                self.epoch_history[key2].append(np.mean([output[key2] for output in outputs if output[key2] != 0.0]))
-                self.epoch_history[key3].append(np.mean([output[key3] for output in outputs if output[key3] != 0.0]))
-
-        self.epoch_history['epoch'].append(self.current_epoch)
-        self.epoch_history['mode'].append('train')
-
-        self.log("recon", self.epoch_history['recon_loss'][-1], prog_bar=True)
-        self.log("r2_mean", self.epoch_history['r2_mean'][-1], prog_bar=True)
-        self.log("adv_loss", self.epoch_history['adv_loss'][-1], prog_bar=True)
-        self.log("acc_pert", self.epoch_history['acc_perts'][-1], prog_bar=True)
-        for covar, nc in self.covars_encoder.items():
-            if len(nc) > 1:
-                self.log(f'acc_{covar}', self.epoch_history[f'acc_{covar}'][-1], prog_bar=True)
+        self.log("recon", means['recon_loss'], prog_bar=True)
+        self.log("r2_mean", means['r2_mean'], prog_bar=True)
+        self.log("adv_loss", means['adv_loss'], prog_bar=True)
+        self.log("acc_pert", means['acc_perts'], prog_bar=True)
+        for key in self._tracked_acc_covar_keys:
+            self.log(key, means[key], prog_bar=True)
 
         if self.current_epoch > 1 and self.current_epoch % self.step_size_lr == 0:
-            sch, sch_doser, sch_adv = self.lr_schedulers()
+            sch = self.lr_schedulers()
             sch.step()
-            sch_doser.step()
-            sch_adv.step()
 
     def validation_step(self, batch, batch_idx):
-        batch, mixup_lambda = self.module.mixup_data(batch, alpha=0.0)  # No mixup during validation
+        module = self.module
+        mixup_data, forward, compute_loss = module.mixup_data, self._forward, self._loss
+
+        batch, mixup_lambda = mixup_data(batch, alpha=0.0)  # No mixup during validation
 
-        inf_outputs, gen_outputs = self.module.forward(batch, compute_loss=False,
-                                                       inference_kwargs={
-                                                           'mixup_lambda': 1.0,
-                                                       })
+        inf_outputs, gen_outputs = forward(batch, compute_loss=False,
+                                           inference_kwargs={
+                                               'mixup_lambda': 1.0,
+                                           })
 
-        recon_loss, kl_loss = self.module.loss(
+        recon_loss, kl_loss = compute_loss(
             tensors=batch,
             inference_outputs=inf_outputs,
             generative_outputs=gen_outputs,
         )
 
-        adv_results = {'adv_loss': 0.0, 'cycle_loss': 0.0, 'penalty_adv': 0.0,
-                       'adv_perts': 0.0, 'acc_perts': 0.0, 'penalty_perts': 0.0}
-        for covar in self.covars_encoder.keys():
-            adv_results[f'adv_{covar}'] = 0.0
-            adv_results[f'acc_{covar}'] = 0.0
-            adv_results[f'penalty_{covar}'] = 0.0
+        adv_results = self._get_zero_results()[0]
 
-        r2_mean, r2_var = self.module.r2_metric(batch, inf_outputs, gen_outputs, mode='direct')
-        disnt_basal, disnt_after = self.module.disentanglement(batch, inf_outputs, gen_outputs)
+        results = {
+            **adv_results,
+            'KL': kl_loss,
+            'recon_loss': recon_loss,
+        }
 
-        results = adv_results
-        results.update({'r2_mean': r2_mean, 'r2_var': r2_var})
-        results.update({'disnt_basal': disnt_basal})
-        results.update({'disnt_after': disnt_after})
-        results.update({'KL': kl_loss.item()})
-        results.update({'recon_loss': recon_loss.item()})
-        results.update({'cpa_metric': r2_mean + 0.5 * r2_var + math.e ** (disnt_after - disnt_basal)})
+        self._val_steps.write(results)
+        self._cache_validation_outputs(batch, inf_outputs, gen_outputs)
 
-        return results
+    def _cache_validation_outputs(self, batch, inf_outputs, gen_outputs):
+        """Accumulates the per-gene sums of `r2_metric` and stores the latents and labels for `disentanglement`"""
+        statistics = self.module.r2_statistics(batch, gen_outputs)
+        if self._val_r2_statistics is None:
+            self._val_r2_statistics = statistics
+        else:
+            self._val_r2_statistics += statistics
+        self._val_n_obs += batch[CPA_REGISTRY_KEYS.X_KEY].shape[0]
+
+        # only (n_cells, n_latent) latents and label vectors are kept until the end of the epoch
+        tensors, inference = self._val_cache
+        for key in self._val_label_keys:
+            tensors.setdefault(key, []).append(batch[key].detach())
+        for key in ('z_basal', 'z'):
+            inference.setdefault(key, []).append(inf_outputs[key].detach())
+
+    def on_validation_epoch_start(self):
+        n_steps = self.trainer.num_sanity_val_steps if self.trainer.sanity_checking else sum(self.trainer.num_val_batches)
+        self._val_steps.reset(n_steps, like=self._zero)
+        self._val_cache = ({}, {})
+        self._val_r2_statistics = None
+        self._val_n_obs = 0
 
     def validation_epoch_end(self, outputs):
-        for key in self.metrics:
-            self.epoch_history[key].append(np.mean([output[key] for output in outputs if output[key] != 0.0]))
-
-        for covar, unique_covars in self.covars_encoder.items():
-            if len(unique_covars) > 1:
-                key1, key2, key3 = f'adv_{covar}', f'penalty_{covar}', f'acc_{covar}'
-                self.epoch_history[key1].append(np.mean([output[key1] for output in outputs if output[key1] != 0.0]))
-                self.epoch_history[key2].append(np.mean([output[key2] for output in outputs if output[key2] != 0.0]))
-                self.epoch_history[key3].append(np.mean([output[key3] for output in outputs if output[key3] != 0.0]))
-
-        self.epoch_history['epoch'].append(self.current_epoch)
-        self.epoch_history['mode'].append('valid')
-
-        self.log('val_recon', self.epoch_history['recon_loss'][-1], prog_bar=True)
-        self.log('cpa_metric', np.mean([output['cpa_metric'] for output in outputs]), prog_bar=False)
-        self.log('disnt_basal', self.epoch_history['disnt_basal'][-1], prog_bar=True)
-        self.log('disnt_after', self.epoch_history['disnt_after'][-1], prog_bar=True)
-        self.log('val_r2_mean', self.epoch_history['r2_mean'][-1], prog_bar=True)
-        self.log('val_r2_var', self.epoch_history['r2_var'][-1], prog_bar=False)
-        self.log('val_KL', self.epoch_history['KL'][-1], prog_bar=True)
+        tensors, inf_outputs = [{key: torch.cat(values) for key, values in cache.items()}
+                                for cache in self._val_cache]
+        self._val_cache = None
+
+        r2_mean, r2_var = self.module.r2_from_statistics(self._val_r2_statistics, self._val_n_obs)
+        self._val_r2_statistics = None
+        disnt_basal, disnt_after = self.module.disentanglement(tensors, inf_outputs, None)
+
+        means = self._val_steps.nonzero_means()
+        # the purity scores are host floats if the latents are on CPU, tensors on the latents' device otherwise
+        scores = [torch.as_tensor(score, dtype=r2_mean.dtype, device=r2_mean.device)
+                  for score in (r2_mean, r2_var, disnt_basal, disnt_after)]
+        means.update(zip(self._val_epoch_keys, torch.stack(scores).cpu().tolist()))
+        cpa_metric = means['r2_mean'] + 0.5 * means['r2_var'] + math.e ** (means['disnt_after'] - means['disnt_basal'])
+        self.epoch_history.append(means, epoch=self.current_epoch, mode='valid')
+
+        self.log('val_recon', means['recon_loss'], prog_bar=True)
+        self.log('cpa_metric', cpa_metric, prog_bar=False)
+        self.log('disnt_basal', means['disnt_basal'], prog_bar=True)
+        self.log('disnt_after', means['disnt_after'], prog_bar=True)
+        self.log('val_r2_mean', means['r2_mean'], prog_bar=True)
+        self.log('val_r2_var', means['r2_var'], prog_bar=False)
+        self.log('val_KL', means['KL'], prog_bar=True)
 
         if self.current_epoch % self.n_epochs_verbose == self.n_epochs_verbose - 1:
             print(f'\ndisnt_basal = {self.epoch_history["disnt_basal"][-1]}')
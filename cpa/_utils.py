@@ -30,6 +30,46 @@ class _REGISTRY_KEYS:
 CPA_REGISTRY_KEYS = _REGISTRY_KEYS()
 
 
+@torch.jit.script
+def nb_log_prob(x: torch.Tensor, mu: torch.Tensor, theta: torch.Tensor, eps: float = 1e-8) -> torch.Tensor:
+    """
+        Log-likelihood of `x` under a Negative Binomial with mean `mu` and inverse dispersion `theta`.
+        Scripted so that the elementwise terms are fused into a single kernel.
+    """
+    log_theta_mu_eps = torch.log(theta + mu + eps)
+    return (
+            theta * (torch.log(theta + eps) - log_theta_mu_eps)
+            + x * (torch.log(mu + eps) - log_theta_mu_eps)
+            + torch.lgamma(x + theta)
+            - torch.lgamma(theta)
+            - torch.lgamma(x + 1)
+    )
+
+
+@torch.jit.script
+def zinb_log_prob(x: torch.Tensor, mu: torch.Tensor, theta: torch.Tensor, zi_logits: torch.Tensor,
+                  eps: float = 1e-8) -> torch.Tensor:
+    """
+        Log-likelihood of `x` under a Zero-Inflated Negative Binomial with mean `mu`, inverse dispersion `theta`
+        and dropout logits `zi_logits`. Scripted so that the elementwise terms are fused into a single kernel.
+    """
+    softplus_pi = F.softplus(-zi_logits)
+    log_theta_mu_eps = torch.log(theta + mu + eps)
+    pi_theta_log = -zi_logits + theta * (torch.log(theta + eps) - log_theta_mu_eps)
+
+    case_zero = F.softplus(pi_theta_log) - softplus_pi
+    case_non_zero = (
+            -softplus_pi
+            + pi_theta_log
+            + x * (torch.log(mu + eps) - log_theta_mu_eps)
+            + torch.lgamma(x + theta)
+            - torch.lgamma(theta)
+            - torch.lgamma(x + 1)
+    )
+
+    return (x < eps).float() * case_zero + (x > eps).float() * case_non_zero
+
+
 class VanillaEncoder(nn.Module):
     def __init__(
             self,
@@ -132,10 +172,17 @@ class PerturbationNetwork(nn.Module):
                  doser_type='logsigm',
                  n_hidden=None,
                  n_layers=None,
-                 dropout_rate: float = 0.0):
+                 dropout_rate: float = 0.0,
+                 n_covars: Optional[List[int]] = None):
         super().__init__()
         self.n_latent = n_latent
-        self.pert_embedding = nn.Embedding(n_perts + 1, n_latent, padding_idx=CPA_REGISTRY_KEYS.PADDING_IDX)
+        self.n_perts = n_perts
+        n_covars = list(n_covars) if n_covars is not None else []
+        # perturbations (padding row first) followed by the values of each covariate, in a single table
+        self.embedding = nn.Embedding(n_perts + 1 + sum(n_covars), n_latent,
+                                      padding_idx=CPA_REGISTRY_KEYS.PADDING_IDX)
+        n_covars = torch.tensor(n_covars, dtype=torch.long)
+        self.register_buffer('covars_offsets', n_perts + 1 + n_covars.cumsum(0) - n_covars, persistent=False)
         self.doser_type = doser_type
         if self.doser_type == 'mlp':
             self.dosers = nn.ModuleList()
@@ -154,20 +201,38 @@ class PerturbationNetwork(nn.Module):
         else:
             self.dosers = GeneralizedSigmoid(n_perts, non_linearity=self.doser_type)
 
-    def forward(self, perts, dosages):
+    def forward(self, perts, dosages, covars=None):
         """
             perts: (batch_size, max_comb_len)
             dosages: (batch_size, max_comb_len)
+            covars: (batch_size, n_covars), optional
+
+            Returns the dose-weighted perturbation embeddings and the summed covariate embeddings, or `None`
+            in their place if `covars` is not given.
         """
         perts = perts.long()
-        scaled_dosages = self.dosers(dosages, perts)  # (batch_size, max_comb_len)
-        drug_embeddings = self.pert_embedding(perts)  # (batch_size, max_comb_len, n_latent)
-
-        z_drugs = torch.einsum('bm,bme->bme', [scaled_dosages, drug_embeddings])  # (batch_size, n_latent)
-
-        z_drugs = torch.einsum('bmn,bm->bmn', z_drugs, (perts > 0).int()).sum(dim=1)  # mask single perts
-
-        return z_drugs
+        if self.doser_type == 'linear':
+            # doses are used as-is
+            scaled_dosages = dosages.float()
+        else:
+            scaled_dosages = self.dosers(dosages, perts) * (perts > 0)  # (batch_size, max_comb_len), mask single perts
+
+        if covars is None:
+            # scaling, masking and summing reduce to a weighted bag of embeddings
+            z_drugs = F.embedding_bag(perts, self.embedding.weight, per_sample_weights=scaled_dosages,
+                                      mode='sum', padding_idx=self.embedding.padding_idx)  # (batch_size, n_latent)
+            return z_drugs, None
+
+        # each row is split into two bags: the dose-weighted perturbations and the covariates with weight 1
+        ids = torch.cat([perts, covars.long() + self.covars_offsets], dim=-1)  # (batch_size, max_comb_len + n_covars)
+        weights = torch.cat([scaled_dosages, torch.ones_like(covars, dtype=scaled_dosages.dtype)], dim=-1)
+        starts = torch.arange(0, ids.numel(), ids.shape[-1], device=ids.device)
+        offsets = torch.stack([starts, starts + perts.shape[-1]], dim=-1).flatten()
+        bags = F.embedding_bag(ids.flatten(), self.embedding.weight, offsets, mode='sum',
+                               per_sample_weights=weights.flatten(), padding_idx=self.embedding.padding_idx)
+        z_drugs, z_covs = bags.view(-1, 2, self.n_latent).unbind(dim=1)  # (batch_size, n_latent) each
+
+        return z_drugs, z_covs
 
 class FocalLoss(nn.Module):
     """ Inspired by https://github.com/AdeelH/pytorch-multi-class-focal-loss/blob/master/focal_loss.py
@@ -1,9 +1,22 @@
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
 import anndata
 import numpy as np
 import pandas as pd
+import pytest
+import torch
+from scvi.distributions import NegativeBinomial, ZeroInflatedNegativeBinomial
 
-from scvi.data import setup_anndata
 import cpa
+from cpa._data import shard_indices
+from cpa._metrics import knn_purity, knn_purity_gpu
+from cpa._module import CPAModule
+from cpa._task import _EpochHistory, _StepBuffer
+from cpa._utils import CPA_REGISTRY_KEYS, nb_log_prob, zinb_log_prob
 
 
 def generate_synth():
@@ -14,17 +27,15 @@ def generate_synth():
         dict(
             c0=np.random.randn(n_cells),
             c1=np.random.randn(n_cells),
-            drug_name=np.array(["d1", "d2", "d3", "d4", "d5"])[np.random.randint(5, size=n_cells)],
+            drug_name=np.array(["ctrl", "d1", "d2", "d3", "d4"])[np.random.randint(5, size=n_cells)],
             dose_val=np.array([0.1, 0.05, 0.5, 0.25, 0.75])[np.random.randint(5, size=n_cells)],
             covar_1=np.array(["v1", "v2"])[np.random.randint(2, size=n_cells)],
-            covar_2=np.random.randint(10, size=n_cells),
-            control=np.random.randint(10, size=n_cells),
+            covar_2=np.random.randint(10, size=n_cells).astype(str),
             split=np.array(["train", "test", "ood"])[np.random.randint(3, size=n_cells)],
         )
     )
     obs.loc[:, "covar_1"] = obs.loc[:, "covar_1"].astype("category")
     obs.loc[:, "covar_2"] = obs.loc[:, "covar_2"].astype("category")
-    obs.loc[:, "control"] = obs.loc[:, "control"].astype("category")
 
     dataset = anndata.AnnData(
         X=X,
@@ -33,23 +44,151 @@ def generate_synth():
 
     cpa.CPA.setup_anndata(
         dataset,
-        drug_key="drug_name",
-        dose_key='dose_val',
+        perturbation_key="drug_name",
+        control_group="ctrl",
+        dosage_key="dose_val",
         categorical_covariate_keys=["covar_1", "covar_2"],
-        control_key='control'
     )
 
     return dict(dataset=dataset)
 
 
-def test_cpa():
+def test_cpa(tmp_path):
     data = generate_synth()
     dataset = data["dataset"]
     model = cpa.CPA(adata=dataset,
                     n_latent=128,
-                    loss_ae='gauss',
+                    recon_loss='gauss',
                     doser_type='logsigm',
                     split_key='split',
                     )
-    model.train(max_epochs=3, plan_kwargs=dict(autoencoder_lr=1e-4))
+    model.train(max_epochs=3, plan_kwargs=dict(lr=1e-4), early_stopping_patience=5,
+                check_val_every_n_epoch=1, save_path=str(tmp_path))
     model.predict(batch_size=1024)
+
+
+def test_shard_indices():
+    indices = np.arange(10)[::-1]
+    shards = [shard_indices(indices, rank, world_size=3) for rank in range(3)]
+    assert all(len(shard) == 3 for shard in shards)
+    assert len(np.unique(np.concatenate(shards))) == 9
+
+
+def test_shard_indices_reshuffles():
+    indices = np.arange(10)
+    epoch_0 = shard_indices(indices, 0, world_size=2, epoch=0)
+    assert np.array_equal(epoch_0, shard_indices(indices, 0, world_size=2, epoch=0))
+    assert not np.array_equal(epoch_0, shard_indices(indices, 0, world_size=2, epoch=1))
+
+
+@pytest.mark.parametrize('strategy', ["'ddp'", 'DDPStrategy(find_unused_parameters=True)'])
+def test_cpa_ddp(tmp_path, strategy):
+    script = tmp_path / 'train_ddp.py'
+    script.write_text(textwrap.dedent(f"""
+        import json
+        import torch.distributed as dist
+        from pytorch_lightning.strategies import DDPStrategy
+        import cpa
+        from test_cpa import generate_synth
+
+        dataset = generate_synth()['dataset']
+        model = cpa.CPA(adata=dataset, n_latent=16, recon_loss='gauss', split_key='split')
+        model.train(max_epochs=2, use_gpu=False, devices=2, strategy={strategy}, batch_size=128,
+                    early_stopping_patience=5, check_val_every_n_epoch=1, save_path={str(tmp_path)!r})
+        with open({str(tmp_path)!r} + f'/rank_{{dist.get_rank()}}.json', 'w') as f:
+            json.dump(dict(world_size=dist.get_world_size(), n_train_steps=model.training_plan.n_train_steps,
+                           n_train=len(model.train_indices)), f)
+    """))
+    python_path = [os.path.dirname(os.path.dirname(cpa.__file__)), os.path.dirname(__file__)]
+    env = dict(os.environ, PL_TORCH_DISTRIBUTED_BACKEND='gloo',
+               PYTHONPATH=os.pathsep.join(python_path + [os.environ.get('PYTHONPATH', '')]))
+    subprocess.run([sys.executable, '-m', 'torch.distributed.run', '--standalone', '--nproc_per_node=2', str(script)],
+                   check=True, cwd=tmp_path, env=env)
+
+    results = [json.loads((tmp_path / f'rank_{rank}.json').read_text()) for rank in range(2)]
+    assert all(result['world_size'] == 2 for result in results)
+    # each process trains on half of the cells: 2 epochs of ceil((n_train // 2) / batch_size) batches
+    n_batches = -(-(results[0]['n_train'] // 2) // 128)
+    assert all(result['n_train_steps'] == 2 * n_batches for result in results)
+
+
+def test_nb_log_prob():
+    generator = torch.Generator().manual_seed(0)
+    x = torch.randint(0, 50, (64, 20), generator=generator).float()
+    mu = torch.rand(64, 20, generator=generator) * 20
+    theta = torch.rand(64, 20, generator=generator) * 5 + 0.1
+    zi_logits = torch.randn(64, 20, generator=generator)
+
+    assert torch.allclose(nb_log_prob(x, mu, theta),
+                          NegativeBinomial(mu=mu, theta=theta).log_prob(x), atol=1e-4)
+    assert torch.allclose(zinb_log_prob(x, mu, theta, zi_logits),
+                          ZeroInflatedNegativeBinomial(mu=mu, theta=theta, zi_logits=zi_logits).log_prob(x),
+                          atol=1e-4)
+
+
+def test_knn_purity_gpu():
+    rng = np.random.RandomState(0)
+    data = rng.randn(200, 8)
+    labels = rng.randint(4, size=200)
+    data[:, 0] += labels  # partially separated classes
+
+    expected = knn_purity(data, labels, n_neighbors=10)
+    score = knn_purity_gpu(torch.from_numpy(data), torch.from_numpy(labels), n_neighbors=10, chunk_size=64)
+    assert np.isclose(score.item(), expected)
+
+
+def test_disentanglement():
+    module = CPAModule(n_genes=10, n_perts=4, covars_encoder={'covar_1': {'v1': 0, 'v2': 1}}, n_latent=8)
+    generator = torch.Generator().manual_seed(0)
+    tensors = {CPA_REGISTRY_KEYS.PERTURBATION_KEY: torch.randint(3, (300,), generator=generator),
+               'covar_1': torch.randint(2, (300,), generator=generator)}
+    inference_outputs = {'z_basal': torch.randn(300, 8, generator=generator),
+                         'z': torch.randn(300, 8, generator=generator)}
+
+    for max_cells in [None, 100]:
+        expected = module.disentanglement(tensors, inference_outputs, None, use_gpu_knn=False, max_cells=max_cells)
+        scores = module.disentanglement(tensors, inference_outputs, None, use_gpu_knn=True, max_cells=max_cells)
+        assert np.allclose([score.item() for score in scores], expected)
+
+
+def test_step_buffer():
+    buffer = _StepBuffer(['a', 'b'])
+    buffer.reset(2, like=torch.zeros(()))
+    for step in range(5):
+        buffer.write({'a': torch.tensor(step + 1.0), 'b': torch.tensor(0.0)})
+
+    means = buffer.nonzero_means()
+    assert means['a'] == 3.0
+    assert np.isnan(means['b'])  # all-zero columns have no non-zero steps to average
+
+
+def test_epoch_history():
+    history = _EpochHistory(['a', 'b'], capacity=2)
+    for epoch in range(5):
+        history.append({'a': float(epoch)}, epoch=epoch, mode='train' if epoch % 2 == 0 else 'valid')
+
+    assert history.n_epochs == 5
+    assert list(history.keys()) == ['epoch', 'mode', 'a', 'b']
+    history = history.to_dict()
+    assert list(history['epoch']) == list(range(5))
+    assert list(history['mode']) == ['train', 'valid', 'train', 'valid', 'train']
+    assert list(history['a']) == [0.0, 1.0, 2.0, 3.0, 4.0]
+    assert np.isnan(history['b']).all()
+
+
+def test_load_embeddings():
+    covars_encoder = {'covar_1': {'v1': 0, 'v2': 1}, 'covar_2': {'a': 0, 'b': 1, 'c': 2}}
+    module = CPAModule(n_genes=10, n_perts=4, covars_encoder=covars_encoder, n_latent=8)
+
+    # older checkpoints store one table for perturbations and one per covariate
+    state_dict = module.state_dict()
+    embedding = state_dict.pop('pert_network.embedding.weight').clone()
+    n_rows = [int(module.pert_network.covars_offsets[0]), 2, 3]
+    for key, weight in zip(['pert_network.pert_embedding', 'covars_embeddings.covar_1', 'covars_embeddings.covar_2'],
+                           embedding.split(n_rows)):
+        state_dict[f'{key}.weight'] = weight.clone()
+
+    module.pert_network.embedding.weight.data.zero_()
+    module.load_state_dict(state_dict)
+    assert torch.equal(module.pert_network.embedding.weight, embedding)
+    assert torch.equal(module.covar_embeddings('covar_2', torch.tensor([1])), embedding[n_rows[0] + 2 + 1].view(1, -1))